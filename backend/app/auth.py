@@ -15,12 +15,13 @@ import uuid
 
 from schema import *
 import mail
-from database import db
+from database import db, async_db
 
 expiry = int(os.environ.get("LOGIN_EXPIRY_MINUTES"))
 interval = int(os.environ.get("LOGIN_INTERVAL_SECONDS"))
 
 users = db["users"]
+async_users = async_db["users"]
 login_log = db["login-log"]
 login_log.create_index("date", expireAfterSeconds=60 * expiry)
 
@@ -186,4 +187,10 @@ def get_user(user_token: Annotated[TokenData, Depends(http_jwt)]) -> User:
     user = users.find_one({"identifier": user_token.identifier})
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return User(**user)
\ No newline at end of file
+    return User(**user)
+
+async def get_user_async(user_token: Annotated[TokenData, Depends(http_jwt)]) -> User:
+    user = await async_users.find_one({"identifier": user_token.identifier})
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return User(**user)
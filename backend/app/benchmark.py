@@ -0,0 +1,184 @@
+# app/benchmark.py
+# Author: Larry Qiu
+# Date: 10/18/2026
+# Purpose: Rough latency benchmarks. Run inside the app container:
+#          python3.9 benchmark.py menu [date] [slug] [menu-type-slug]
+#          python3.9 benchmark.py images
+#          python3.9 benchmark.py concurrency [date] [slug] [menu-type-slug] [requests]
+#          python3.9 benchmark.py notifications [subscriptions]
+
+import os
+import sys
+import time
+import base64
+import asyncio
+import statistics
+from io import BytesIO
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+def timed(fn, *args, repeat: int = 20) -> dict[str, float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "mean_ms": statistics.mean(samples),
+        "median_ms": statistics.median(samples),
+        "max_ms": max(samples),
+    }
+
+def report(name: str, result: dict[str, float]):
+    print(f"{name:<40} mean {result['mean_ms']:9.3f} ms  median {result['median_ms']:9.3f} ms  max {result['max_ms']:9.3f} ms", flush=True)
+
+def linear_find_sibling_hashes(hash: str) -> list[str]:
+    # The pre-index implementation, kept here as the baseline
+    import menu_management
+    for food_name, hashes in menu_management.food_versions.items():
+        if hash in hashes:
+            return hashes
+
+    return [hash]
+
+def benchmark_sibling_hashes():
+    import menu_management
+    all_hashes = list(menu_management.food_version_groups.keys())
+    sample = all_hashes[::max(1, len(all_hashes) // 200)]
+
+    def run(lookup):
+        for hash in sample:
+            lookup(hash)
+
+    print(f"find_sibling_hashes over {len(sample)} hashes ({len(all_hashes)} indexed)", flush=True)
+    report("  linear scan", timed(run, linear_find_sibling_hashes))
+    report("  hash index", timed(run, menu_management.find_sibling_hashes))
+
+def benchmark_daily_menu(date: str, slug: str, menu_type_slug: str):
+    import menu_management
+    print(f"get_menu {date} {slug} {menu_type_slug}", flush=True)
+
+    def run(name):
+        # Both sides start from the same state: an empty in-process tier,
+        # filled by one untimed call so neither pays the cold Mongo reads
+        menu_management.latest_version_local_cache.clear()
+        menu_management.get_menu(date, slug, menu_type_slug)
+        report(name, timed(menu_management.get_menu, date, slug, menu_type_slug, repeat=5))
+
+    indexed = menu_management.find_sibling_hashes
+    menu_management.find_sibling_hashes = linear_find_sibling_hashes
+    try:
+        run("  linear scan")
+    finally:
+        menu_management.find_sibling_hashes = indexed
+
+    run("  hash index")
+
+def benchmark_concurrent_daily_menu(date: str, slug: str, menu_type_slug: str, requests: int = 200):
+    # Compares serving a burst of daily-menu requests on the default threadpool
+    # (40 threads, as the sync routes ran) against the async PyMongo path.
+    # build_menu_async skips the menu cache so both sides build every menu.
+    import menu_management
+    print(f"{requests} concurrent get_menu {date} {slug} {menu_type_slug}", flush=True)
+
+    def run_sync():
+        with ThreadPoolExecutor(max_workers=40) as executor:
+            list(executor.map(lambda _: menu_management.get_menu(date, slug, menu_type_slug), range(requests)))
+
+    async def gather_async():
+        await asyncio.gather(*[menu_management.build_menu_async(date, slug, menu_type_slug) for _ in range(requests)])
+
+    def run_async():
+        # The async client binds to the running loop, so reuse one loop across repeats
+        loop.run_until_complete(gather_async())
+
+    loop = asyncio.new_event_loop()
+    try:
+        report("  sync on threadpool", timed(run_sync, repeat=5))
+        report("  async on event loop", timed(run_async, repeat=5))
+    finally:
+        loop.close()
+
+def benchmark_notifications(subscriptions: int = 200):
+    # Resolves a user's followed items one at a time, as get_notifications
+    # used to, against the single bulk lookup. The in-process tier is cleared
+    # before every run so both go to Mongo.
+    import menu_management
+    hashes = [item["hash"] for item in menu_management.menu_items.find({}, {"hash": 1}).limit(subscriptions)]
+    print(f"Resolving {len(hashes)} followed items", flush=True)
+
+    def run_each():
+        menu_management.latest_version_local_cache.clear()
+        for hash in hashes:
+            menu_management.find_sibling_hashes(hash)
+            menu_management.find_latest_item_version(hash)
+
+    def run_bulk():
+        menu_management.latest_version_local_cache.clear()
+        menu_management.find_latest_item_versions(hashes)
+
+    report("  one lookup per item", timed(run_each, repeat=5))
+    report("  bulk lookup", timed(run_bulk, repeat=5))
+
+def full_decode_load_image_bytes(image_bytes: bytes, max_width:int=1024, max_height:int=1024) -> str:
+    # The pre-draft implementation, kept here as the baseline
+    from PIL import Image
+
+    image = Image.open(BytesIO(image_bytes))
+    image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG")
+    b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    url = f"data:image/jpeg;base64,{b64}"
+    return url
+
+def benchmark_images(image_dir: str = "./demo_images"):
+    import images
+
+    image_paths = sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir))
+    image_bytes = []
+    for image_path in image_paths:
+        with open(image_path, "rb") as file:
+            image_bytes.append(file.read())
+
+    def run(load):
+        for data in image_bytes:
+            load(data)
+
+    print(f"Preprocessing {len(image_bytes)} images from {image_dir}", flush=True)
+    report("  full decode", timed(run, full_decode_load_image_bytes, repeat=3))
+    report("  draft decode", timed(run, images.load_image_bytes, repeat=3))
+
+    async def run_concurrent():
+        await asyncio.gather(*[images.preprocess_image(BytesIO(data)) for data in image_bytes])
+
+    report("  draft decode on worker pool", timed(lambda: asyncio.run(run_concurrent()), repeat=3))
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "menu"
+
+    if command == "images":
+        benchmark_images()
+
+    if command == "menu":
+        date = sys.argv[2] if len(sys.argv) > 2 else datetime.now().strftime("%Y-%m-%d")
+        slug = sys.argv[3] if len(sys.argv) > 3 else "dewick-dining"
+        menu_type_slug = sys.argv[4] if len(sys.argv) > 4 else "lunch"
+
+        benchmark_sibling_hashes()
+        benchmark_daily_menu(date, slug, menu_type_slug)
+
+    if command == "concurrency":
+        date = sys.argv[2] if len(sys.argv) > 2 else datetime.now().strftime("%Y-%m-%d")
+        slug = sys.argv[3] if len(sys.argv) > 3 else "dewick-dining"
+        menu_type_slug = sys.argv[4] if len(sys.argv) > 4 else "lunch"
+        requests = int(sys.argv[5]) if len(sys.argv) > 5 else 200
+
+        benchmark_concurrent_daily_menu(date, slug, menu_type_slug, requests)
+
+    if command == "notifications":
+        subscriptions = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+        benchmark_notifications(subscriptions)
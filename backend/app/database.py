@@ -3,6 +3,10 @@
 # Date: 1/22/2023
 # Purpose: Define the database connection
 
-from pymongo import MongoClient
+from pymongo import MongoClient, AsyncMongoClient
 client = MongoClient('mongodb://mongo:27017/')
 db = client['jumbo-appetit']
+
+# Used by the async request handlers so they never block the event loop
+async_client = AsyncMongoClient('mongodb://mongo:27017/')
+async_db = async_client['jumbo-appetit']
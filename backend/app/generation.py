@@ -0,0 +1,89 @@
+# app/generation.py
+# Author: Larry Qiu
+# Date: 10/18/2026
+# Purpose: Global data generation number and the in-process caches keyed by it
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Hashable, Optional
+
+from database import db, async_db
+
+# A single document {_id: "menus", generation: n, completed_scraping_date: d}.
+# Anything that changes what the menu routes return (a scraper run, a menu or
+# calendar rebuild, a change to the version groups) increments it; the scraper
+# writes it directly, along with the scraping_date of the last run it finished.
+GENERATION_ID = "menus"
+
+generations = db["data-generation"]
+async_generations = async_db["data-generation"]
+
+def read_generation() -> int:
+    result = generations.find_one({"_id": GENERATION_ID})
+    return result["generation"] if result is not None else 0
+
+def read_completed_scraping_date() -> Optional[datetime]:
+    # Every document of a run shares its scraping_date, so passes bounded by
+    # this never see part of a run that is still being stored
+    result = generations.find_one({"_id": GENERATION_ID})
+    return result.get("completed_scraping_date") if result is not None else None
+
+def bump_generation() -> int:
+    result = generations.find_one_and_update(
+        {"_id": GENERATION_ID},
+        {"$inc": {"generation": 1}},
+        upsert=True,
+        return_document=True
+    )
+    set_generation(result["generation"])
+    return result["generation"]
+
+generation = read_generation()
+
+def set_generation(new_generation: int) -> bool:
+    global generation
+    if new_generation == generation:
+        return False
+
+    print(f"Data generation {generation} -> {new_generation}", flush=True)
+    generation = new_generation
+    return True
+
+async def refresh_generation() -> bool:
+    result = await async_generations.find_one({"_id": GENERATION_ID})
+    return set_generation(result["generation"] if result is not None else 0)
+
+class GenerationCache:
+    # An LRU whose entries are only valid for the generation they were
+    # computed in, so nothing is served after the data it came from changed.
+    # Used from the event loop and from worker threads, hence the lock.
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.stats["misses"] += 1
+                return False, None
+
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return True, entry[1]
+
+    def put(self, key: Hashable, value: Any, entry_generation: int):
+        # Callers pass the generation read before computing value, so a result
+        # raced by a bump is stored as already stale
+        with self.lock:
+            self.entries[key] = (entry_generation, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
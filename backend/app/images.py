@@ -0,0 +1,59 @@
+# app/images.py
+# Author: Larry Qiu
+# Date: 10/18/2026
+# Purpose: Image preprocessing for the vision endpoint, run on a worker pool
+#          so decoding never blocks the event loop
+
+import base64
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import BinaryIO
+from PIL import Image
+
+# Pillow releases the GIL while decoding, resizing and encoding
+image_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("VISION_IMAGE_WORKERS", "2")))
+
+def perceptual_hash(image: Image.Image) -> int:
+    # 64-bit difference hash: each bit records whether a pixel of a 9x8
+    # grayscale thumbnail is brighter than its right-hand neighbour
+    pixels = list(image.convert("L").resize((9, 8), Image.Resampling.BILINEAR).getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+
+    return value
+
+def prepare_image(file: BinaryIO, max_width:int=1024, max_height:int=1024) -> tuple[str, int]:
+    image = Image.open(file)
+
+    # For JPEGs, draft mode lets the decoder downscale by up to 8x while
+    # decoding, so the full-resolution bitmap is never built
+    image.draft("RGB", (max_width, max_height))
+    image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG")
+    b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    url = f"data:image/jpeg;base64,{b64}"
+    return url, perceptual_hash(image)
+
+def load_image_file(file: BinaryIO, max_width:int=1024, max_height:int=1024) -> str:
+    return prepare_image(file, max_width, max_height)[0]
+
+def load_image(image_path: str, max_width:int=1024, max_height:int=1024) -> str:
+    with open(image_path, "rb") as file:
+        return load_image_file(file, max_width, max_height)
+
+def load_image_bytes(image_bytes: bytes, max_width:int=1024, max_height:int=1024) -> str:
+    return load_image_file(BytesIO(image_bytes), max_width, max_height)
+
+async def preprocess_image(file: BinaryIO, max_width:int=1024, max_height:int=1024) -> tuple[str, int]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_executor, prepare_image, file, max_width, max_height)
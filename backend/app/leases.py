@@ -0,0 +1,73 @@
+# app/leases.py
+# Author: Larry Qiu
+# Date: 10/18/2026
+# Purpose: Mongo-backed leases for electing a single writer among app workers
+
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+
+leases = db["leases"]
+
+class Lease:
+    # A named lease held by at most one worker at a time. The holder renews it
+    # every third of its ttl; if it dies, another worker takes over once it
+    # expires and runs the on_acquired callbacks.
+    def __init__(self, name: str, ttl_seconds: int = 60):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = False
+        self.released = False
+        self.on_acquired: list[Callable[[], None]] = []
+
+    def try_acquire(self) -> bool:
+        now = datetime.now()
+        try:
+            leases.update_one(
+                {"_id": self.name, "$or": [{"holder": self.holder}, {"expires": {"$lt": now}}]},
+                {"$set": {"holder": self.holder, "expires": now + timedelta(seconds=self.ttl_seconds)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # Held by another worker, so the filter missed and the upsert collided
+            return False
+
+    def renew(self):
+        was_held = self.held
+        self.held = self.try_acquire()
+
+        if self.held and not was_held:
+            print(f"Acquired {self.name} lease as {self.holder}", flush=True)
+            for callback in self.on_acquired:
+                threading.Thread(target=callback, daemon=True).start()
+
+    def keep(self):
+        while True:
+            time.sleep(self.ttl_seconds / 3)
+            if self.released:
+                return
+            try:
+                self.renew()
+            except Exception as e:
+                self.held = False
+                print(f"Failed to renew {self.name} lease: {e}", flush=True)
+
+    def release(self):
+        # Lets another worker take over right away instead of after the ttl
+        self.released = True
+        self.held = False
+        leases.delete_one({"_id": self.name, "holder": self.holder})
+
+    def start(self):
+        # The first attempt is synchronous so callers can check held right away
+        self.renew()
+        threading.Thread(target=self.keep, daemon=True).start()
@@ -3,25 +3,37 @@
 # Date: 1/22/2023
 # Purpose: API definition and app entrypoint
 
-from fastapi import FastAPI, APIRouter, Depends
-from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Request, Response, Query
+from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse, JSONResponse
 from fastapi import File, UploadFile
+from starlette.datastructures import Headers
 
 import os
+import pytz
 from datetime import datetime
 from typing import Optional
 import json
+import asyncio
+import hashlib
 
 from schema import *
 import mail
 import auth
 import menu_management
-from database import db
+import generation
+from database import db, async_db
 import vision
 
 users = db["users"]
+async_users = async_db["users"]
 
 DOMAIN = os.environ.get("DOMAIN")
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+# Room for the multipart boundaries, part headers and query-like fields
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+CONFIG_WATCH_INTERVAL_SECONDS = float(os.environ.get("CONFIG_WATCH_INTERVAL_SECONDS", "10"))
+GENERATION_POLL_INTERVAL_SECONDS = float(os.environ.get("GENERATION_POLL_INTERVAL_SECONDS", "5"))
+HTTP_CACHE_MAX_AGE_SECONDS = int(os.environ.get("HTTP_CACHE_MAX_AGE_SECONDS", "60"))
 
 tags_metadata = [
     {
@@ -49,36 +61,209 @@ tags_metadata = [
 app = FastAPI(openapi_tags=tags_metadata, openapi_url="/api/openapi.json", docs_url="/api/docs")
 api = APIRouter(prefix="/api")
 
+# Config hot reload
+
+async def reload_config(force: bool = False) -> dict[str, bool]:
+    changed = await asyncio.to_thread(menu_management.reload_changed_config, force)
+    if changed["food_versions"]:
+        await vision.update_embeddings()
+    return changed
+
+async def watch_config():
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL_SECONDS)
+        try:
+            await reload_config()
+
+            # Retries a failed first load, and lets workers that are not the
+            # config writer pick up embeddings it generated for new names
+            if not vision.embeddings_ready.is_set() or vision.missing_embeddings() > 0:
+                await vision.update_embeddings()
+        except Exception as e:
+            print(f"Failed to reload config: {e}", flush=True)
+
+config_watcher = None
+
+@app.on_event("startup")
+async def start_config_watcher():
+    global config_watcher
+    if CONFIG_WATCH_INTERVAL_SECONDS > 0:
+        config_watcher = asyncio.create_task(watch_config())
+
+# Data generation polling
+# One point read per interval per worker; the menu cache and the ETags
+# follow the generation, so a finished scrape shows up within the interval
+
+async def watch_generation():
+    while True:
+        await asyncio.sleep(GENERATION_POLL_INTERVAL_SECONDS)
+        try:
+            changed = await generation.refresh_generation()
+
+            # A scrape finished, so the config writer files its new hashes and
+            # refreshes the latest versions it touched (bumping the generation
+            # again once done)
+            if changed and menu_management.config_writer.held:
+                await asyncio.to_thread(menu_management.update_after_scrape)
+        except Exception as e:
+            print(f"Failed to refresh data generation: {e}", flush=True)
+
+generation_watcher = None
+
+@app.on_event("startup")
+async def start_generation_watcher():
+    global generation_watcher
+    generation_watcher = asyncio.create_task(watch_generation())
+
+# Conditional GET
+# Menu responses only change with the data generation or the config, so
+# their ETags are derived from those versions and checked before any work
+
+def make_etag(*parts: Any) -> str:
+    return '"' + hashlib.md5(":".join(str(part) for part in parts).encode()).hexdigest() + '"'
+
+def cache_headers(etag: str) -> dict[str, str]:
+    return {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={HTTP_CACHE_MAX_AGE_SECONDS}, must-revalidate",
+    }
+
+def not_modified(request: Request, response: Response, etag: str) -> Optional[Response]:
+    # Returns a 304 if the client already has this version, otherwise tags
+    # the outgoing response with the ETag
+    headers = cache_headers(etag)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return None
+
 # Menu Related Routes
 
 @api.get("/menu/locations", tags=["menu"])
-def get_locations() -> list[Location]:
+def get_locations(request: Request, response: Response) -> list[Location]:
+    etag = make_etag("locations", menu_management.config_mtimes.get("locations"))
+    if (cached := not_modified(request, response, etag)) is not None:
+        return cached
+
     return list(menu_management.locations.values())
 
 @api.get("/menu/food-properties", tags=["menu"])
-def get_food_properties() -> list[FoodProperty]:
+def get_food_properties(request: Request, response: Response) -> list[FoodProperty]:
+    etag = make_etag("food-properties", menu_management.config_mtimes.get("food_properties"))
+    if (cached := not_modified(request, response, etag)) is not None:
+        return cached
+
     return list(menu_management.food_properties.values())
 
 @api.get("/menu/monthly-view/{location-slug}/{menu-type-slug}/{year}/{month}", tags=["menu"])
-def get_monthly_view(location_slug: str, menu_type_slug: str, year: int, month: int) -> list[MonthlyViewDay]:
-    return menu_management.get_monthly_view(year, month, location_slug, menu_type_slug)
+async def get_monthly_view(location_slug: str, menu_type_slug: str, year: int, month: int, request: Request, response: Response) -> list[MonthlyViewDay]:
+    etag = make_etag("monthly-view", location_slug, menu_type_slug, year, month, generation.generation)
+    if (cached := not_modified(request, response, etag)) is not None:
+        return cached
+
+    return await menu_management.get_monthly_view_async(year, month, location_slug, menu_type_slug)
 
 @api.get("/menu/daily-menu/{location-slug}/{menu-type-slug}/{year}/{month}/{day}", tags=["menu"])
-def get_daily_menu(location_slug: str, menu_type_slug: str, year: int, month: int, day: int) -> Optional[Menu]:
+async def get_daily_menu(location_slug: str, menu_type_slug: str, year: int, month: int, day: int, request: Request, response: Response) -> Optional[Menu]:
     date = f"{year:04}-{month:02}-{day:02}"
-    menu = menu_management.get_menu(date, location_slug, menu_type_slug)
+
+    # Latest versions depend on the version groups as well as the scrapes
+    etag = make_etag("daily-menu", location_slug, menu_type_slug, date, generation.generation, menu_management.config_mtimes.get("food_versions"))
+    if (cached := not_modified(request, response, etag)) is not None:
+        return cached
+
+    menu = await menu_management.get_menu_async(date, location_slug, menu_type_slug)
     return menu
 
 @api.get("/menu/latest-item-version/{hash}", tags=["menu"])
-def get_latest_item_version(hash: MenuItemHash) -> Optional[DatedMenuItem]:
-    return menu_management.find_latest_item_version(hash)
+async def get_latest_item_version(hash: MenuItemHash) -> Optional[DatedMenuItem]:
+    return await menu_management.find_latest_item_version_async(hash)
 
 # Vision Related Routes
 
-@api.post("/vision/analyze-image", tags=["vision"])
-async def analyze_image(image: UploadFile = File(...)) -> StreamingResponse:
-    return StreamingResponse(vision.analyze_image(await image.read()), media_type="text/event-stream")
-
+class UploadTooLarge(Exception):
+    pass
+
+class LimitUploadSize:
+    # Pure ASGI so other routes pass straight through. The multipart body is
+    # parsed before the route runs, so the limit is enforced while it is
+    # received: from Content-Length when sent, otherwise by counting chunks.
+    def __init__(self, app, path: str, max_bytes: int):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        too_large = JSONResponse(status_code=413, content={"detail": "Image too large"})
+
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await too_large(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise UploadTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # Whatever error the app makes of the aborted read is replaced below
+            if exceeded:
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+
+        if exceeded and not response_started:
+            await too_large(scope, receive, send)
+
+app.add_middleware(LimitUploadSize, path="/api/vision/analyze-image", max_bytes=MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES)
+
+@api.post("/vision/analyze-image", tags=["vision"], description="Optionally pass a location and menu type (and date, default today) to only match against that menu")
+async def analyze_image(image: UploadFile = File(...), location_slug: Optional[str] = None, menu_type_slug: Optional[str] = None, date: Optional[Date] = None) -> StreamingResponse:
+    if location_slug is not None and menu_type_slug is not None and date is None:
+        date = datetime.now(pytz.timezone('US/Eastern')).strftime("%Y-%m-%d")
+
+    # LimitUploadSize bounds the whole body; this bounds the image itself
+    if image.size is not None and image.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Image too large")
+
+    # FastAPI closes the upload once the streamed response has been sent
+    return StreamingResponse(vision.analyze_image(image.file, date, location_slug, menu_type_slug), media_type="text/event-stream")
+
+
+@api.get("/vision/status", tags=["vision"])
+def get_vision_status() -> dict[str, Any]:
+    return {
+        "ready": vision.embeddings_ready.is_set(),
+        "menu_items": len(vision.embeddings) if vision.embeddings is not None else 0,
+        "missing_menu_items": vision.missing_embeddings(),
+    }
 
 # Feed Related Routes
 
@@ -98,21 +283,23 @@ def authorize_login(code: str):
 def login_authorized(login_token: Token) -> Token:
     return auth.login_authorized(login_token)
 
-@api.get("/user/notifications", tags=["user"])
-def get_notifications(user: Annotated[User, Depends(auth.get_user)]) -> list[NotifiedItem]:
+@api.get("/user/notifications", tags=["user"], description="Pass offset and limit to page through long lists")
+async def get_notifications(user: Annotated[User, Depends(auth.get_user_async)], offset: int = Query(0, ge=0), limit: Optional[int] = Query(None, ge=1)) -> list[NotifiedItem]:
+    # Items without a known version are skipped, so a page may be shorter than limit
+    hashes = user.notified_items[offset:offset + limit if limit is not None else None]
+    latest_versions = await menu_management.find_latest_item_versions_async(hashes)
 
     result = []
-    for hash in user.notified_items:
-        sibling_hashes = menu_management.find_sibling_hashes(hash)
-        latest_version = menu_management.find_latest_item_version(hash)
+    for hash in hashes:
+        latest_version = latest_versions[hash]
         if latest_version is None:
             continue
-        result.append(NotifiedItem(latest_version=latest_version, hashes=sibling_hashes))
+        result.append(NotifiedItem(latest_version=latest_version, hashes=menu_management.find_sibling_hashes(hash)))
 
     return result
 
 @api.post("/user/register-notification", tags=["user"])
-def register_notification(menu_item_hash: str, registered: bool, expo_push_token: Optional[str], user: Annotated[User, Depends(auth.get_user)]) -> None:
+async def register_notification(menu_item_hash: str, registered: bool, expo_push_token: Optional[str], user: Annotated[User, Depends(auth.get_user_async)]) -> None:
     sibling_hashes = menu_management.find_sibling_hashes(menu_item_hash)
     if expo_push_token is not None:
         user.notification_token = expo_push_token
@@ -129,7 +316,7 @@ def register_notification(menu_item_hash: str, registered: bool, expo_push_token
             if hash in user.notified_items:
                 user.notified_items.remove(menu_item_hash)    
 
-    users.update_one({"identifier": user.identifier}, {"$set": {"notified_items": user.notified_items, "notification_token": user.notification_token}})
+    await async_users.update_one({"identifier": user.identifier}, {"$set": {"notified_items": user.notified_items, "notification_token": user.notification_token}})
 
 
 # Admin Related Routes
@@ -144,6 +331,18 @@ def authorize(code: str):
     mail.save_refresh_token(code)
     return HTMLResponse("<h1>Authorized!</h1>")
     
+@api.get("/admin/stats", tags=["admin"], description="Cache statistics")
+def get_stats() -> dict[str, dict[str, Any]]:
+    return {
+        "query_embedding_cache": vision.query_embedding_cache.stats,
+        "latest_version_cache": menu_management.latest_version_cache_stats(),
+        "menu_cache": {**menu_management.menu_cache.stats, "entries": len(menu_management.menu_cache.entries), "generation": generation.generation},
+    }
+
+@api.post("/admin/reload-config", tags=["admin"], description="Reload the config files now")
+async def reload_config_now() -> dict[str, bool]:
+    return await reload_config(force=True)
+
 @api.get("/admin/send-test-email", tags=["admin"], description="Send test email")
 def send_test_email():
     test_email_addr = os.environ.get("EMAIL")
@@ -4,23 +4,83 @@
 # Purpose: Helper functions for interacting with scraped menu data
 
 from schema import *
-from database import db
+from database import db, async_db
+from leases import Lease
+import generation
 import typing
 from datetime import datetime, timedelta
 from ruamel.yaml import YAML
+from pymongo import UpdateOne
+import threading
+import tempfile
+import shutil
+import time
+import os
 
 raw_scrape_results = db["raw-scrape-results"]
 raw_scrape_results.create_index([("scraping_result.menu_items.hash", 1)])
 raw_scrape_results.create_index([("slug", 1), ("menu_type_slug", 1), ("date", 1), ("scraping_date", 1)])
+raw_scrape_results.create_index("scraping_date")
+raw_scrape_results.create_index("last_seen_date")
 
-latest_item_version_cache = db["latest-item-version-cache"]
-latest_item_version_cache.create_index("cache_date", expireAfterSeconds=60 * 60 * 24)
-latest_item_version_cache.create_index("hashes")
+config_watermarks = db["config-watermarks"]
+
+menu_items = db["menu-items"]
+menu_items.create_index("hash", unique=True)
+menu_items.create_index("food_version")
+
+menus = db["menus"]
+menus.create_index([("slug", 1), ("menu_type_slug", 1), ("date", 1)], unique=True)
+
+menu_calendar = db["menu-calendar"]
+menu_calendar.create_index([("slug", 1), ("menu_type_slug", 1), ("month", 1)], unique=True)
+
+# The latest DatedMenuItem of every version group (or of every ungrouped
+# hash), maintained from the scrape results so lookups are point reads.
+# It replaces the latest-item-version-cache collection, which the
+# drop-latest-item-version-cache command removes.
+latest_versions = db["latest-versions"]
+latest_versions.create_index("group", unique=True)
+latest_versions.create_index("hashes")
+
+# Held while latest-versions is rebuilt or refreshed so the two never interleave
+latest_versions_lock = threading.Lock()
+
+# Async handles on the collections read by the hot request paths
+async_raw_scrape_results = async_db["raw-scrape-results"]
+async_menus = async_db["menus"]
+async_menu_calendar = async_db["menu-calendar"]
+async_latest_versions = async_db["latest-versions"]
 
 food_versions = {}
+food_version_groups = {}
 food_properties = {}
 locations = {}
 
+CONFIG_FILES = {
+    "food_versions": "config/food_versions.yml",
+    "food_properties": "config/food_properties.yml",
+    "locations": "config/locations.yml",
+}
+
+# Held while the config dicts are replaced or merged with reconciliation
+# results, so a hot reload never races a reconcile pass writing the same file
+config_lock = threading.RLock()
+config_mtimes = {}
+
+# With several workers, only the lease holder reconciles config and writes
+# shared state; the others load what it writes
+config_writer = Lease("config-writer")
+
+# Built menus and monthly views, valid until the data generation changes
+MENU_CACHE_SIZE = int(os.environ.get("MENU_CACHE_SIZE", "1024"))
+menu_cache = generation.GenerationCache(MENU_CACHE_SIZE)
+
+# Per-worker tier in front of latest-versions, keyed by version group
+LATEST_VERSION_CACHE_SIZE = int(os.environ.get("LATEST_VERSION_CACHE_SIZE", "8192"))
+latest_version_local_cache = generation.GenerationCache(LATEST_VERSION_CACHE_SIZE)
+latest_version_stats = {"memory_hits": 0, "database_hits": 0, "misses": 0, "miss_seconds": 0.0, "max_miss_seconds": 0.0}
+
 def hash_unhashed_scraped_results():
     query = {
         "scraping_result.menu_items.hash": {"$exists": False}
@@ -42,37 +102,55 @@ def hash_unhashed_scraped_results():
             {"$set": {"scraping_result.menu_items": menu_items}}
         )
 
-def find_best_scrape_result(date_str: Date, slug: str, menu_type_slug: str) -> Optional[dict[str, Any]]:
+def best_scrape_queries(date_str: Date, slug: str, menu_type_slug: str) -> list[tuple[dict[str, Any], int]]:
     date = datetime.strptime(date_str, "%Y-%m-%d")
-    # First, find the youngest scrape result that is on or before the date
-    query = {
-        "scraping_date": {"$lte": date + timedelta(days=1)},
-        "date": date_str,
-        "slug": slug,
-        "menu_type_slug": menu_type_slug
-    }
-
-    results = list(raw_scrape_results.find(query).sort("scraping_date", -1).limit(1))
-
-    if len(results) == 0:
+    return [
+        # First, find the youngest scrape result that is on or before the date
+        ({
+            "scraping_date": {"$lte": date + timedelta(days=1)},
+            "date": date_str,
+            "slug": slug,
+            "menu_type_slug": menu_type_slug
+        }, -1),
         # if there are no scrape results on or before the date, find the oldest scrape result that is on or after the date
-        query = {
+        ({
             "scraping_date": {"$gte": date - timedelta(days=1)},
             "date": date_str,
             "slug": slug,
             "menu_type_slug": menu_type_slug
-        }
+        }, 1),
+    ]
 
-        results = list(raw_scrape_results.find(query).sort("scraping_date", 1).limit(1))
+def find_best_scrape_result(date_str: Date, slug: str, menu_type_slug: str) -> Optional[dict[str, Any]]:
+    for query, direction in best_scrape_queries(date_str, slug, menu_type_slug):
+        results = list(raw_scrape_results.find(query).sort("scraping_date", direction).limit(1))
+        if len(results) > 0:
+            return results[0]
 
-    if len(results) == 0:
-        return None
-    
-    return results[0]
+    return None
 
-    
-def get_unique_hashes() -> list[dict[str, Any]]:
-    result = raw_scrape_results.aggregate([
+async def find_best_scrape_result_async(date_str: Date, slug: str, menu_type_slug: str) -> Optional[dict[str, Any]]:
+    for query, direction in best_scrape_queries(date_str, slug, menu_type_slug):
+        results = await async_raw_scrape_results.find(query).sort("scraping_date", direction).limit(1).to_list(1)
+        if len(results) > 0:
+            return results[0]
+
+    return None
+
+def scraping_date_range(since: Optional[datetime], until: Optional[datetime]) -> list[dict[str, Any]]:
+    scraping_date = {}
+    if since is not None:
+        scraping_date["$gt"] = since
+    if until is not None:
+        scraping_date["$lte"] = until
+
+    if len(scraping_date) == 0:
+        return []
+
+    return [{'$match': {'scraping_date': scraping_date}}]
+
+def get_unique_hashes(since: Optional[datetime] = None, until: Optional[datetime] = None) -> list[dict[str, Any]]:
+    result = raw_scrape_results.aggregate(scraping_date_range(since, until) + [
         {
             '$unwind': {
                 'path': '$scraping_result.menu_items', 
@@ -90,8 +168,8 @@ def get_unique_hashes() -> list[dict[str, Any]]:
 
     return list(result)
 
-def get_food_properties() -> list[FoodProperty]:
-    result = raw_scrape_results.aggregate([
+def get_food_properties(since: Optional[datetime] = None, until: Optional[datetime] = None) -> list[FoodProperty]:
+    result = raw_scrape_results.aggregate(scraping_date_range(since, until) + [
         {
             '$unwind': {
                 'path': '$scraping_result.menu_items', 
@@ -117,8 +195,8 @@ def get_food_properties() -> list[FoodProperty]:
 
     return [FoodProperty(slug=food_property["_id"], name=food_property["foodName"], description=food_property["description"], displayed=False) for food_property in result]
 
-def get_locations() -> list[Location]:
-    result = raw_scrape_results.aggregate([
+def get_locations(since: Optional[datetime] = None, until: Optional[datetime] = None) -> list[Location]:
+    result = raw_scrape_results.aggregate(scraping_date_range(since, until) + [
         {
             '$group': {
                 '_id': [
@@ -139,113 +217,353 @@ def get_locations() -> list[Location]:
 
     return list(locations.values())
 
-def reload_food_versions():
-    global food_versions
-
-    file_path = "config/food_versions.yml"
+# Config reconciliation only looks at scrape documents newer than the last
+# scraping_date it processed, which is persisted per config file.
+
+def get_watermark(name: str) -> Optional[datetime]:
+    result = config_watermarks.find_one({"_id": name})
+    return result["scraping_date"] if result is not None else None
+
+def set_watermark(name: str, scraping_date: Optional[datetime]):
+    if scraping_date is None:
+        return
+
+    config_watermarks.update_one({"_id": name}, {"$set": {"scraping_date": scraping_date}}, upsert=True)
+
+def build_food_version_groups(versions: dict[str, list[MenuItemHash]]) -> dict[MenuItemHash, str]:
+    groups = {}
+    for food_name, hashes in versions.items():
+        for hash in hashes:
+            # Keep the first group a hash appears in, matching the old linear scan
+            groups.setdefault(hash, food_name)
+
+    return groups
+
+def sync_catalog_food_versions(groups: dict[MenuItemHash, str], hashes: Optional[list[MenuItemHash]] = None):
+    # The scraper files new hashes under their own food name; bring the
+    # catalog in line with any regrouping done in food_versions.yml, for every
+    # item or only the given hashes
+    query = {} if hashes is None else {"hash": {"$in": hashes}}
+    operations = []
+    for item in menu_items.find(query, {"hash": 1, "food_version": 1}):
+        food_version = groups.get(item["hash"])
+        if food_version is not None and food_version != item.get("food_version"):
+            operations.append(UpdateOne({"_id": item["_id"]}, {"$set": {"food_version": food_version}}))
+
+    if len(operations) > 0:
+        menu_items.bulk_write(operations, ordered=False)
+
+def changed_food_versions(old_versions: dict[str, list[MenuItemHash]], new_versions: dict[str, list[MenuItemHash]]) -> set[str]:
+    names = set(old_versions.keys()) | set(new_versions.keys())
+    return set(name for name in names if set(old_versions.get(name, [])) != set(new_versions.get(name, [])))
+
+def invalidate_food_versions(old_versions: dict[str, list[MenuItemHash]], changed_names: set[str]):
+    # Latest versions are kept per group, so every group touching a regrouped
+    # hash is rebuilt
+    affected_hashes = set()
+    for name in changed_names:
+        affected_hashes.update(old_versions.get(name, []))
+        affected_hashes.update(food_versions.get(name, []))
+
+    if len(affected_hashes) > 0 and config_writer.held:
+        rebuild_latest_versions_for(list(affected_hashes))
+    if len(affected_hashes) > 0:
+        latest_version_local_cache.clear()
+
+    if config_writer.held:
+        sync_catalog_food_versions(food_version_groups)
+
+    # Every worker drops the menus it built with the old groups; the writer
+    # also moves the other workers and the HTTP caches to a new generation
+    if len(changed_names) > 0:
+        menu_cache.clear()
+        if config_writer.held:
+            generation.bump_generation()
+
+def write_config_file(file_path: str, yaml: YAML, data: Any):
+    # Written to a temporary file and swapped in, so workers polling the file
+    # never parse a partial write
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as file:
+            yaml.dump(data, file)
+        shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def edited_since_loaded(name: str) -> bool:
+    # True if the file was changed on disk after it was last loaded or written
+    return os.path.getmtime(CONFIG_FILES[name]) != config_mtimes.get(name)
+
+def load_food_versions() -> tuple[dict[str, list[MenuItemHash]], set[str]]:
+    global food_versions, food_version_groups
+
+    file_path = CONFIG_FILES["food_versions"]
 
     yaml = YAML()
-    
-    with open(file_path, 'r') as file:
-        food_versions = yaml.load(file)
 
-    if food_versions is None:
-        food_versions = {}
-    
-    unique_hashes = get_unique_hashes()
+    with config_lock:
+        config_mtimes["food_versions"] = os.path.getmtime(file_path)
+        with open(file_path, 'r') as file:
+            new_food_versions = yaml.load(file)
 
-    existing_hashes = set([hash for hashes in food_versions.values() for hash in hashes])
-    for unique_hash in unique_hashes:
-        hash = unique_hash["_id"]
-        food_name = unique_hash["foodName"]
+        if new_food_versions is None:
+            new_food_versions = {}
 
-        if hash is None:
-            continue
+        new_food_version_groups = build_food_version_groups(new_food_versions)
 
-        
-        if hash not in existing_hashes:
-            if food_name not in food_versions:
-                food_versions[food_name] = []
+        old_food_versions = food_versions
+
+        # Both dicts are fully built before either is published. They are still two
+        # global stores, so a reader may briefly pair the new versions with the old
+        # groups; find_sibling_hashes checks the group against versions for that
+        food_versions, food_version_groups = new_food_versions, new_food_version_groups
+
+    return old_food_versions, changed_food_versions(old_food_versions, new_food_versions)
+
+def reconcile_food_versions(until: Optional[datetime], full: bool = False):
+    global food_versions, food_version_groups
+
+    file_path = CONFIG_FILES["food_versions"]
 
-            food_versions[food_name].append(hash)
+    since = None if full else get_watermark("food_versions")
+    unique_hashes = get_unique_hashes(since, until)
 
-    with open(file_path, 'w') as file:
-        yaml.dump(dict(sorted(food_versions.items())), file)
+    reloaded = None
+    with config_lock:
+        # Merge into an edit the watcher has not picked up yet instead of
+        # writing over it
+        if edited_since_loaded("food_versions"):
+            reloaded = load_food_versions()
 
-    print("Food versions reloaded", flush=True)
+        new_food_versions = {food_name: list(hashes) for food_name, hashes in food_versions.items()}
 
-reload_food_versions()
+        existing_hashes = set(food_version_groups.keys())
+        added_hashes = []
+        changed = False
+        for unique_hash in unique_hashes:
+            hash = unique_hash["_id"]
+            food_name = unique_hash["foodName"]
 
-def reload_food_properties():
+            if hash is None:
+                continue
+
+
+            if hash not in existing_hashes:
+                if food_name not in new_food_versions:
+                    new_food_versions[food_name] = []
+
+                new_food_versions[food_name].append(hash)
+                added_hashes.append(hash)
+                changed = True
+
+        if changed:
+            new_food_version_groups = build_food_version_groups(new_food_versions)
+
+            # Both dicts are fully built before either is published. They are still two
+            # global stores, so a reader may briefly pair the new versions with the old
+            # groups; find_sibling_hashes checks the group against versions for that
+            food_versions, food_version_groups = new_food_versions, new_food_version_groups
+
+            yaml = YAML()
+            write_config_file(file_path, yaml, dict(sorted(new_food_versions.items())))
+            config_mtimes["food_versions"] = os.path.getmtime(file_path)
+
+    if reloaded is not None:
+        invalidate_food_versions(*reloaded)
+
+    set_watermark("food_versions", until)
+
+    if changed:
+        # Only the new hashes can disagree with the catalog; regroupings are
+        # synced in full when the file is reloaded
+        sync_catalog_food_versions(food_version_groups, added_hashes)
+
+        # A new hash can join an existing group, whose latest version then has
+        # to be recomputed over all of its hashes
+        rebuild_latest_versions_for(added_hashes)
+        latest_version_local_cache.clear()
+        menu_cache.clear()
+        generation.bump_generation()
+
+    print(f"Food versions reconciled ({len(unique_hashes)} hashes since {since})", flush=True)
+
+def load_food_properties():
     global food_properties
 
-    file_path = "config/food_properties.yml"
+    file_path = CONFIG_FILES["food_properties"]
 
     yaml = YAML()
 
     yaml.register_class(FoodProperty)
 
-    with open(file_path, 'r') as file:
-        food_properties = yaml.load(file)
+    with config_lock:
+        config_mtimes["food_properties"] = os.path.getmtime(file_path)
+        with open(file_path, 'r') as file:
+            new_food_properties = yaml.load(file)
 
-    if food_properties is None:
-        food_properties = {}
+        if new_food_properties is None:
+            new_food_properties = {}
 
-    food_properties = {key: FoodProperty(**value) for key, value in food_properties.items()}
-    
-    unique_food_properties = get_food_properties()
+        food_properties = {key: FoodProperty(**value) for key, value in new_food_properties.items()}
 
-    existing_food_properties = set([food_property.slug for food_property in food_properties.values()])
-    for food_property in unique_food_properties:
-        if food_property.slug not in existing_food_properties:
-            food_properties[food_property.slug] = food_property
+def reconcile_food_properties(until: Optional[datetime], full: bool = False):
+    global food_properties
+
+    file_path = CONFIG_FILES["food_properties"]
+
+    since = None if full else get_watermark("food_properties")
+    unique_food_properties = get_food_properties(since, until)
+
+    with config_lock:
+        if edited_since_loaded("food_properties"):
+            load_food_properties()
 
-    with open(file_path, 'w') as file:
-        yaml.dump(dict(sorted([(key, value.model_dump()) for key, value in food_properties.items()])), file)
+        new_food_properties = dict(food_properties)
 
-    print("Food properties reloaded", flush=True)
+        existing_food_properties = set([food_property.slug for food_property in new_food_properties.values()])
+        changed = False
+        for food_property in unique_food_properties:
+            if food_property.slug not in existing_food_properties:
+                new_food_properties[food_property.slug] = food_property
+                changed = True
 
-reload_food_properties()
+        if changed:
+            food_properties = new_food_properties
 
-def reload_locations():
+            yaml = YAML()
+            yaml.register_class(FoodProperty)
+            write_config_file(file_path, yaml, dict(sorted([(key, value.model_dump()) for key, value in new_food_properties.items()])))
+            config_mtimes["food_properties"] = os.path.getmtime(file_path)
+
+    set_watermark("food_properties", until)
+
+    print("Food properties reconciled", flush=True)
+
+def load_locations():
     global locations
 
-    file_path = "config/locations.yml"
+    file_path = CONFIG_FILES["locations"]
 
     yaml = YAML()
 
     yaml.register_class(Location)
 
-    with open(file_path, 'r') as file:
-        locations = yaml.load(file)
+    with config_lock:
+        config_mtimes["locations"] = os.path.getmtime(file_path)
+        with open(file_path, 'r') as file:
+            new_locations = yaml.load(file)
 
-    if locations is None:
-        locations = {}
+        if new_locations is None:
+            new_locations = {}
 
-    locations = {key: Location(**value) for key, value in locations.items()}
-    
-    unique_locations = get_locations()
+        locations = {key: Location(**value) for key, value in new_locations.items()}
 
-    existing_locations = set([location.slug for location in locations.values()])
-    for location in unique_locations:
-        if location.slug not in existing_locations:
-            locations[location.slug] = location
-
-    with open(file_path, 'w') as file:
-        yaml.dump(dict(sorted([(key, value.model_dump()) for key, value in locations.items()])), file)
-
-    print("Locations reloaded", flush=True)
+def reconcile_locations(until: Optional[datetime], full: bool = False):
+    global locations
 
-reload_locations()
+    file_path = CONFIG_FILES["locations"]
+
+    since = None if full else get_watermark("locations")
+    unique_locations = get_locations(since, until)
+
+    with config_lock:
+        if edited_since_loaded("locations"):
+            load_locations()
+
+        new_locations = dict(locations)
+
+        existing_locations = set([location.slug for location in new_locations.values()])
+        changed = False
+        for location in unique_locations:
+            if location.slug not in existing_locations:
+                new_locations[location.slug] = location
+                changed = True
+
+        if changed:
+            locations = new_locations
+
+            yaml = YAML()
+            yaml.register_class(Location)
+            write_config_file(file_path, yaml, dict(sorted([(key, value.model_dump()) for key, value in new_locations.items()])))
+            config_mtimes["locations"] = os.path.getmtime(file_path)
+
+    set_watermark("locations", until)
+
+    print("Locations reconciled", flush=True)
+
+def reconcile_config(full: bool = False):
+    # Bound every pass by the last completed scrape run. A run in progress
+    # already has documents at its scraping_date; bounding by those would
+    # move the watermark past the rest of the run.
+    until = generation.read_completed_scraping_date()
+    reconcile_food_versions(until, full)
+    reconcile_food_properties(until, full)
+    reconcile_locations(until, full)
+
+def update_after_scrape():
+    # Run by the config writer when it takes over and after every scrape. New
+    # hashes are filed into groups first so the refresh keys them correctly.
+    reconcile_config()
+    refresh_latest_versions()
+
+def take_over_config_in_background():
+    # food_versions.yml may have been regrouped while no process was watching
+    # it, so the new writer brings the catalog and the groups it disagrees
+    # with in line first
+    try:
+        sync_catalog_food_versions(food_version_groups)
+        repair_latest_versions()
+        update_after_scrape()
+    except Exception as e:
+        print(f"Failed to take over config: {e}", flush=True)
+
+def reload_changed_config(force: bool = False) -> dict[str, bool]:
+    # Re-parses config files edited since they were last loaded or written and
+    # invalidates only what depends on them
+    changed = {}
+    for name in CONFIG_FILES:
+        changed[name] = force or edited_since_loaded(name)
+
+    if changed["food_versions"]:
+        old_food_versions, changed_names = load_food_versions()
+        invalidate_food_versions(old_food_versions, changed_names)
+        print(f"Food versions reloaded ({len(changed_names)} groups changed)", flush=True)
+
+    if changed["food_properties"]:
+        load_food_properties()
+        print("Food properties reloaded", flush=True)
+
+    if changed["locations"]:
+        load_locations()
+        print("Locations reloaded", flush=True)
+
+    return changed
+
+load_food_versions()
+load_food_properties()
+load_locations()
+
+def find_food_version(hash: MenuItemHash) -> Optional[str]:
+    return food_version_groups.get(hash)
 
 def find_sibling_hashes(hash: MenuItemHash) -> list[MenuItemHash]:
-    for food_name, hashes in food_versions.items():
-        if hash in hashes:
-            return hashes
-    
-    return [hash]
+    versions = food_versions
+    food_name = food_version_groups.get(hash)
+    if food_name is None or food_name not in versions:
+        return [hash]
+
+    return versions[food_name]
 
 def get_menu_item(hash: MenuItemHash) -> Optional[MenuItem]:
+    result = menu_items.find_one({"hash": hash}, {"menu_item": 1})
+
+    if result is not None:
+        return MenuItem(**result["menu_item"])
+
+    # Not in the catalog yet, fall back to the scrape history and backfill it
     result = raw_scrape_results.aggregate([
         {
             '$match': {
@@ -260,6 +578,19 @@ def get_menu_item(hash: MenuItemHash) -> Optional[MenuItem]:
             '$match': {
                 'scraping_result.menu_items.hash': hash
             }
+        }, {
+            '$group': {
+                '_id': '$scraping_result.menu_items.hash', 
+                'menu_item': {
+                    '$first': '$scraping_result.menu_items'
+                }, 
+                'first_seen_date': {
+                    '$min': '$date'
+                }, 
+                'last_seen_date': {
+                    '$max': '$date'
+                }
+            }
         }
     ])
 
@@ -267,140 +598,478 @@ def get_menu_item(hash: MenuItemHash) -> Optional[MenuItem]:
 
     if len(result) == 0:
         return None
-    
-    return scrape_to_menu_item(result[0]["scraping_result"]["menu_items"])
 
-def find_latest_item_version(hash: MenuItemHash) -> Optional[DatedMenuItem]:
-    result = latest_item_version_cache.find_one({"hashes": hash})
+    operation = catalog_upsert(result[0])
+    if operation is None:
+        return None
 
-    if result is not None:
-        del result["_id"]
-        del result["cache_date"]
-        del result["hashes"]
+    menu_items.bulk_write([operation])
+    return scrape_to_menu_item(result[0]["menu_item"])
 
-        return DatedMenuItem(**result)
+def catalog_upsert(result: dict[str, Any]) -> Optional[UpdateOne]:
+    menu_item = scrape_to_menu_item(result["menu_item"])
+    if menu_item is None:
+        return None
 
-    sibling_hashes = find_sibling_hashes(hash)
-    
-    query = [
+    return UpdateOne(
+        {"hash": menu_item.hash},
         {
-            '$match': {
-                'scraping_result.menu_items.hash': {
-                    '$in': sibling_hashes
+            "$setOnInsert": {"menu_item": menu_item.model_dump()},
+            "$set": {"food_version": find_food_version(menu_item.hash) or menu_item.name},
+            "$min": {"first_seen_date": result["first_seen_date"]},
+            "$max": {"last_seen_date": result["last_seen_date"]},
+        },
+        upsert=True
+    )
+
+def rebuild_catalog():
+    result = raw_scrape_results.aggregate([
+        {
+            '$unwind': {
+                'path': '$scraping_result.menu_items', 
+                'preserveNullAndEmptyArrays': False
+            }
+        }, {
+            '$group': {
+                '_id': '$scraping_result.menu_items.hash', 
+                'menu_item': {
+                    '$first': '$scraping_result.menu_items'
+                }, 
+                'first_seen_date': {
+                    '$min': '$date'
+                }, 
+                'last_seen_date': {
+                    '$max': '$date'
                 }
             }
+        }
+    ], allowDiskUse=True)
+
+    operations = []
+    for item in result:
+        if item["_id"] is None:
+            continue
+
+        operation = catalog_upsert(item)
+        if operation is not None:
+            operations.append(operation)
+
+        if len(operations) >= 1000:
+            menu_items.bulk_write(operations, ordered=False)
+            operations = []
+
+    if len(operations) > 0:
+        menu_items.bulk_write(operations, ordered=False)
+
+    print("Rebuilt menu item catalog", flush=True)
+
+def cache_to_dated_menu_item(result: dict[str, Any]) -> DatedMenuItem:
+    return DatedMenuItem(menu_item=result["menu_item"], date=result["date"], latest_version=result["latest_version"])
+
+def version_group_key(hash: MenuItemHash) -> str:
+    # Grouped hashes share their food version name; ungrouped ones stand alone
+    food_name = food_version_groups.get(hash)
+    return food_name if food_name is not None and food_name in food_versions else hash
+
+def group_sibling_hashes(hashes: list[MenuItemHash]) -> dict[str, list[MenuItemHash]]:
+    return {version_group_key(hash): find_sibling_hashes(hash) for hash in hashes}
+
+def read_local_latest_versions(groups: dict[str, list[MenuItemHash]]) -> tuple[dict[str, Optional[DatedMenuItem]], list[str]]:
+    latest = {}
+    missing_keys = []
+    for key in groups:
+        found, dated_menu_item = latest_version_local_cache.get(key)
+        if found:
+            latest[key] = dated_menu_item
+            latest_version_stats["memory_hits"] += 1
+        else:
+            missing_keys.append(key)
+
+    return latest, missing_keys
+
+def apply_cached_versions(groups: dict[str, list[MenuItemHash]], cached: list[dict[str, Any]], latest: dict[str, Optional[DatedMenuItem]], missing_keys: list[str], cache_generation: int) -> list[str]:
+    for result in cached:
+        # Built for a group with other hashes than it has now, so treat it as a miss
+        if set(result.get("hashes", [])) != set(groups[result["group"]]):
+            continue
+
+        dated_menu_item = cache_to_dated_menu_item(result)
+        latest[result["group"]] = dated_menu_item
+        latest_version_local_cache.put(result["group"], dated_menu_item, cache_generation)
+        latest_version_stats["database_hits"] += 1
+
+    return [key for key in missing_keys if key not in latest]
+
+def latest_versions_query(match: dict[str, Any], hashes: Optional[list[MenuItemHash]] = None) -> list[dict[str, Any]]:
+    # Latest appearance of every hash in the matched documents, or only of
+    # the given hashes
+    query = [
+        {
+            '$match': match
         },
         {
             '$unwind': {
                 'path': '$scraping_result.menu_items', 
                 'preserveNullAndEmptyArrays': False
             }
-        }, {
+        }
+    ]
+
+    if hashes is not None:
+        query.append({
             '$match': {
                 'scraping_result.menu_items.hash': {
-                    '$in': sibling_hashes
+                    '$in': hashes
                 }
             }
-        }, {
+        })
+
+    return query + [
+        {
             '$addFields': {
                 'date': {
                     '$toDate': '$date'
+                }, 
+                'last_seen_date': {
+                    '$ifNull': ['$last_seen_date', '$scraping_date']
                 }
             }
         }, {
-            '$sort': {
-                'scraping_date': -1, 
-                'date': -1
+            '$group': {
+                '_id': '$scraping_result.menu_items.hash', 
+                'latest': {
+                    '$top': {
+                        'sortBy': {
+                            'last_seen_date': -1, 
+                            'date': -1
+                        }, 
+                        'output': {
+                            'last_seen_date': '$last_seen_date', 
+                            'date': '$scraping_result.date', 
+                            'menu_item': '$scraping_result.menu_items'
+                        }
+                    }
+                }
             }
-        }, {
-            '$limit': 1
         }
     ]
 
-    result = list(raw_scrape_results.aggregate(query))
+def group_latest_versions_query(groups: dict[str, list[MenuItemHash]]) -> list[dict[str, Any]]:
+    hashes = [hash for sibling_hashes in groups.values() for hash in sibling_hashes]
+    return latest_versions_query({'scraping_result.menu_items.hash': {'$in': hashes}}, hashes)
+
+def apply_latest_versions(groups: dict[str, list[MenuItemHash]], results: list[dict[str, Any]], latest: dict[str, Optional[DatedMenuItem]], cache_generation: int) -> list[UpdateOne]:
+    # Reduces the per-hash aggregation results to one latest version per group,
+    # fills them into latest and returns the upserts for the shared tier
+    latest_by_hash = {result["_id"]: result["latest"] for result in results}
+
+    operations = []
+    for key, sibling_hashes in groups.items():
+        candidates = [latest_by_hash[hash] for hash in sibling_hashes if hash in latest_by_hash]
+        menu_item = None
+        if len(candidates) > 0:
+            result = max(candidates, key=lambda x: (x["last_seen_date"], x["date"]))
+            menu_item = scrape_to_menu_item(result["menu_item"])
+
+        if menu_item is None:
+            # Remember the absence locally so it is not recomputed every request
+            latest[key] = None
+            latest_version_local_cache.put(key, None, cache_generation)
+            continue
 
-    if len(result) == 0:
-        return None
-    
-    result = result[0]
+        dated_menu_item = DatedMenuItem(menu_item=menu_item, date=result["date"], latest_version=None)
+        latest[key] = dated_menu_item
+        latest_version_local_cache.put(key, dated_menu_item, cache_generation)
+
+        document = dated_menu_item.model_dump()
+        document["hashes"] = sibling_hashes
+        document["last_seen_date"] = result["last_seen_date"]
+        operations.append(UpdateOne({"group": key}, {"$set": document}, upsert=True))
+
+    return operations
+
+def record_latest_version_miss(count: int, seconds: float):
+    latest_version_stats["misses"] += count
+    latest_version_stats["miss_seconds"] += seconds
+    latest_version_stats["max_miss_seconds"] = max(latest_version_stats["max_miss_seconds"], seconds)
+
+def latest_version_cache_stats() -> dict[str, Any]:
+    lookups = latest_version_stats["memory_hits"] + latest_version_stats["database_hits"] + latest_version_stats["misses"]
+    misses = latest_version_stats["misses"]
+    return {
+        **latest_version_stats,
+        "hit_ratio": 1 - misses / lookups if lookups > 0 else None,
+        "mean_miss_seconds": latest_version_stats["miss_seconds"] / misses if misses > 0 else None,
+        "entries": len(latest_version_local_cache.entries),
+    }
 
-    menu_item = scrape_to_menu_item(result["scraping_result"]["menu_items"])
+def find_latest_item_versions(hashes: list[MenuItemHash]) -> dict[MenuItemHash, Optional[DatedMenuItem]]:
+    # Resolve the latest version of every group from the local tier, then
+    # latest-versions. Only hashes scraped since the last refresh (or before
+    # the first build) fall through to an aggregation over scrape results.
+    cache_generation = generation.generation
+    groups = group_sibling_hashes(hashes)
+    latest, missing_keys = read_local_latest_versions(groups)
+
+    if len(missing_keys) > 0:
+        cached = list(latest_versions.find({"group": {"$in": missing_keys}}))
+        missing_keys = apply_cached_versions(groups, cached, latest, missing_keys, cache_generation)
+
+    if len(missing_keys) > 0:
+        start = time.perf_counter()
+        missing_groups = {key: groups[key] for key in missing_keys}
+        results = list(raw_scrape_results.aggregate(group_latest_versions_query(missing_groups)))
+        operations = apply_latest_versions(missing_groups, results, latest, cache_generation)
+
+        if len(operations) > 0:
+            latest_versions.bulk_write(operations, ordered=False)
+        record_latest_version_miss(len(missing_keys), time.perf_counter() - start)
+
+    return {hash: latest.get(version_group_key(hash)) for hash in hashes}
+
+async def find_latest_item_versions_async(hashes: list[MenuItemHash]) -> dict[MenuItemHash, Optional[DatedMenuItem]]:
+    cache_generation = generation.generation
+    groups = group_sibling_hashes(hashes)
+    latest, missing_keys = read_local_latest_versions(groups)
+
+    if len(missing_keys) > 0:
+        cached = await async_latest_versions.find({"group": {"$in": missing_keys}}).to_list(None)
+        missing_keys = apply_cached_versions(groups, cached, latest, missing_keys, cache_generation)
+
+    if len(missing_keys) > 0:
+        start = time.perf_counter()
+        missing_groups = {key: groups[key] for key in missing_keys}
+        results = await (await async_raw_scrape_results.aggregate(group_latest_versions_query(missing_groups))).to_list(None)
+        operations = apply_latest_versions(missing_groups, results, latest, cache_generation)
+
+        if len(operations) > 0:
+            await async_latest_versions.bulk_write(operations, ordered=False)
+        record_latest_version_miss(len(missing_keys), time.perf_counter() - start)
+
+    return {hash: latest.get(version_group_key(hash)) for hash in hashes}
+
+def rebuild_latest_versions():
+    # Recomputes every group from the full scrape history
+    with latest_versions_lock:
+        start = time.perf_counter()
+        until = generation.read_completed_scraping_date()
+
+        results = list(raw_scrape_results.aggregate(latest_versions_query({}), allowDiskUse=True))
+        groups = group_sibling_hashes([result["_id"] for result in results if result["_id"] is not None])
+
+        operations = apply_latest_versions(groups, results, {}, generation.generation)
+        if len(operations) > 0:
+            latest_versions.bulk_write(operations, ordered=False)
+        latest_versions.delete_many({"group": {"$nin": list(groups.keys())}})
+
+        latest_version_local_cache.clear()
+        set_watermark("latest_versions", until)
+
+    generation.bump_generation()
+
+    print(f"Rebuilt {len(operations)} latest versions in {time.perf_counter() - start:.1f}s", flush=True)
+
+def rebuild_latest_versions_for(hashes: list[MenuItemHash]):
+    # Recomputes the groups the hashes belong to now, after dropping the
+    # documents of the groups they belonged to before
+    with latest_versions_lock:
+        groups = group_sibling_hashes(hashes)
+        latest_versions.delete_many({"$or": [{"hashes": {"$in": hashes}}, {"group": {"$in": list(groups.keys())}}]})
+
+        results = list(raw_scrape_results.aggregate(group_latest_versions_query(groups)))
+        operations = apply_latest_versions(groups, results, {}, generation.generation)
+        if len(operations) > 0:
+            latest_versions.bulk_write(operations, ordered=False)
+
+    print(f"Rebuilt {len(operations)} latest versions for {len(hashes)} regrouped hashes", flush=True)
+
+def repair_latest_versions():
+    # Rebuilds every group whose stored hashes differ from its current siblings,
+    # for regroupings made in food_versions.yml while no writer was running
+    stale_hashes = set()
+    for document in latest_versions.find({}, {"group": 1, "hashes": 1}):
+        group = document["group"]
+        hashes = document.get("hashes", [])
+        if group in food_versions:
+            current_hashes = food_versions[group]
+        elif version_group_key(group) == group:
+            current_hashes = [group]
+        else:
+            # An ungrouped hash that has since joined a group
+            current_hashes = []
+
+        if set(hashes) != set(current_hashes):
+            stale_hashes.update(hashes)
+            stale_hashes.update(current_hashes)
+
+    if len(stale_hashes) == 0:
+        return
+
+    rebuild_latest_versions_for(list(stale_hashes))
+    latest_version_local_cache.clear()
+    menu_cache.clear()
+    generation.bump_generation()
+
+def refresh_latest_versions():
+    # Run by the config writer after every scrape. Documents stored or touched
+    # since the watermark are newer than anything in latest-versions, so they
+    # alone decide the new latest version of every group they mention.
+    # Nothing is processed until a scrape run has completed; without a
+    # watermark to store, a rebuild would only be repeated on every call
+    if generation.read_completed_scraping_date() is None:
+        return
+
+    since = get_watermark("latest_versions")
 
-    if menu_item is None:
-        return None
-    
-    dated_menu_item = DatedMenuItem(menu_item=menu_item, date=result["scraping_result"]["date"], latest_version=None)
+    if since is None:
+        rebuild_latest_versions()
+        return
+
+    with latest_versions_lock:
+        until = generation.read_completed_scraping_date()
+
+        if until <= since:
+            return
+
+        start = time.perf_counter()
+        results = list(raw_scrape_results.aggregate(latest_versions_query({"last_seen_date": {"$gt": since, "$lte": until}})))
+        groups = group_sibling_hashes([result["_id"] for result in results if result["_id"] is not None])
+
+        operations = apply_latest_versions(groups, results, {}, generation.generation)
+        if len(operations) > 0:
+            latest_versions.bulk_write(operations, ordered=False)
+
+        latest_version_local_cache.clear()
+        set_watermark("latest_versions", until)
+
+    generation.bump_generation()
+
+    print(f"Refreshed {len(operations)} latest versions in {time.perf_counter() - start:.1f}s", flush=True)
+
+def find_latest_item_version(hash: MenuItemHash) -> Optional[DatedMenuItem]:
+    return find_latest_item_versions([hash])[hash]
+
+async def find_latest_item_version_async(hash: MenuItemHash) -> Optional[DatedMenuItem]:
+    return (await find_latest_item_versions_async([hash]))[hash]
+
+def menu_hashes(menu: Menu) -> list[MenuItemHash]:
+    return [item.menu_item.hash for section in menu.sections for item in section.menu_items]
+
+def apply_menu_versions(menu: Menu, latest_versions: dict[MenuItemHash, Optional[DatedMenuItem]]) -> Menu:
+    for section in menu.sections:
+        for item in section.menu_items:
+            item.latest_version = latest_versions[item.menu_item.hash]
+
+    return menu
+
+def fill_latest_versions(menu: Menu) -> Menu:
+    return apply_menu_versions(menu, find_latest_item_versions(menu_hashes(menu)))
 
-    cache_item = dated_menu_item.model_dump()
-    cache_item["cache_date"] = datetime.now()
-    cache_item["hashes"] = sibling_hashes
-    latest_item_version_cache.insert_one(cache_item)
+async def fill_latest_versions_async(menu: Menu) -> Menu:
+    return apply_menu_versions(menu, await find_latest_item_versions_async(menu_hashes(menu)))
 
-    return dated_menu_item
+def materialized_menu_document(result: dict[str, Any], date: Date, slug: str, menu_type_slug: str) -> dict[str, Any]:
+    menu = scrape_to_base_menu(result["scraping_result"])
 
-def scrape_to_menu(scraping_result: dict[str, Any], find_lastest_version: bool = True) -> Optional[MenuItem]:
-    if "menu_info" not in scraping_result or "menu_items" not in scraping_result:
+    return {
+        "slug": slug,
+        "menu_type_slug": menu_type_slug,
+        "date": date,
+        "scraping_date": result["scraping_date"],
+        "menu": menu.model_dump() if menu is not None else None
+    }
+
+def materialize_menu(date: Date, slug: str, menu_type_slug: str) -> Optional[dict[str, Any]]:
+    result = find_best_scrape_result(date, slug, menu_type_slug)
+
+    if result is None:
         return None
-    date = scraping_result["date"]
-    menu_info = scraping_result["menu_info"]
-    menu_items = scraping_result["menu_items"]
 
-    raw_sections = [{"id": key, "items": [], **value} for key, value in menu_info.items()]
-    raw_sections.sort(key=lambda x: x["position"])
+    document = materialized_menu_document(result, date, slug, menu_type_slug)
+    menus.replace_one({"slug": slug, "menu_type_slug": menu_type_slug, "date": date}, document, upsert=True)
+
+    return document
 
-    for item in menu_items:
-        for section in raw_sections:
-            if str(item["menu_id"]) == str(section["id"]):
-                section["items"].append(item)
+async def materialize_menu_async(date: Date, slug: str, menu_type_slug: str) -> Optional[dict[str, Any]]:
+    result = await find_best_scrape_result_async(date, slug, menu_type_slug)
 
-    for section in raw_sections:
-        section["items"].sort(key=lambda x: x["position"])
+    if result is None:
+        return None
 
-    menu = Menu(date = date, sections = [])
+    document = materialized_menu_document(result, date, slug, menu_type_slug)
+    await async_menus.replace_one({"slug": slug, "menu_type_slug": menu_type_slug, "date": date}, document, upsert=True)
 
-    for raw_section in raw_sections:
-        if "section_options" not in raw_section or raw_section["section_options"] is None:
-            raw_section["section_options"] = {"display_name": "None"}
+    return document
 
-        section = Menu.Section(name=str(raw_section["section_options"]["display_name"]), menu_items=[])
-        for item in raw_section["items"]:
-            menu_item = scrape_to_menu_item(item)
-            if menu_item is None:
-                continue
+def rebuild_menus():
+    result = raw_scrape_results.aggregate([
+        {
+            '$group': {
+                '_id': [
+                    '$slug', '$menu_type_slug', '$date'
+                ]
+            }
+        }
+    ])
 
-            latest_version = find_latest_item_version(menu_item.hash) if find_lastest_version else None
-            section.menu_items.append(DatedMenuItem(menu_item=menu_item, date=date, latest_version=latest_version))
+    count = 0
+    for raw_day in result:
+        slug, menu_type_slug, date = raw_day["_id"]
+        materialize_menu(date, slug, menu_type_slug)
+        count += 1
 
-        if len(section.menu_items) == 0:
-            continue
+    print(f"Rebuilt {count} menus", flush=True)
+
+def get_base_menu(date: Date, slug: str, menu_type_slug: str) -> Optional[Menu]:
+    # The materialized menu without latest versions filled in
+    materialized = menus.find_one({"slug": slug, "menu_type_slug": menu_type_slug, "date": date})
 
-        menu.sections.append(section)
+    if materialized is None:
+        materialized = materialize_menu(date, slug, menu_type_slug)
 
-    if len(menu.sections) == 0:
+    if materialized is None or materialized["menu"] is None:
         return None
 
-    return menu
+    return Menu(**materialized["menu"])
 
 def get_menu(date: Date, slug: str, menu_type_slug: str) -> Optional[Menu]:
-    result = find_best_scrape_result(date, slug, menu_type_slug)
+    menu = get_base_menu(date, slug, menu_type_slug)
 
-    if result is None:
+    if menu is None:
         return None
     
-    return scrape_to_menu(result["scraping_result"])
+    return fill_latest_versions(menu)
+
+async def get_menu_async(date: Date, slug: str, menu_type_slug: str) -> Optional[Menu]:
+    key = ("menu", date, slug, menu_type_slug)
+    found, menu = menu_cache.get(key)
+    if found:
+        return menu
+
+    menu_generation = generation.generation
+    menu = await build_menu_async(date, slug, menu_type_slug)
+    menu_cache.put(key, menu, menu_generation)
+
+    return menu
 
-def get_monthly_view(year: int, month: int, slug: str, menu_type_slug: str) -> list[MonthlyViewDay]:
-    start = datetime(year, month, 1) - timedelta(days=7)
-    end = datetime(year, month, 1) + timedelta(days=31 + 7)
+async def build_menu_async(date: Date, slug: str, menu_type_slug: str) -> Optional[Menu]:
+    materialized = await async_menus.find_one({"slug": slug, "menu_type_slug": menu_type_slug, "date": date})
+
+    if materialized is None:
+        materialized = await materialize_menu_async(date, slug, menu_type_slug)
+
+    if materialized is None or materialized["menu"] is None:
+        return None
+
+    return await fill_latest_versions_async(Menu(**materialized["menu"]))
+
+def rebuild_calendar():
     query = [
         {
-            '$match': {
-                'slug': slug, 
-                'menu_type_slug': menu_type_slug
-            }
-        }, {
             '$group': {
-                '_id': '$date', 
+                '_id': [
+                    '$slug', '$menu_type_slug', '$date'
+                ], 
                 'menu': {
                     '$top': {
                         'sortBy': {
@@ -410,32 +1079,94 @@ def get_monthly_view(year: int, month: int, slug: str, menu_type_slug: str) -> l
                     }
                 }
             }
-        }, {
-            '$addFields': {
-                'date': {
-                    '$toDate': '$menu.date'
-                }
-            }
-        }, {
-            '$match': {
-                'date': {
-                    '$gte': start,
-                    '$lte': end
-                }
-            }
         }
     ]
 
-    result = list(raw_scrape_results.aggregate(query))
+    calendar = {}
 
-    monthly_view = []
+    for result_day in raw_scrape_results.aggregate(query, allowDiskUse=True):
+        slug, menu_type_slug, date = result_day["_id"]
+        key = (slug, menu_type_slug, date[:7])
+        if key not in calendar:
+            calendar[key] = []
 
-    for result_day in result:
-        menu = scrape_to_menu(result_day["menu"]["scraping_result"], find_lastest_version=False)
+        if scrape_to_base_menu(result_day["menu"]["scraping_result"]) is not None:
+            calendar[key].append(date)
 
-        if menu is None:
-            continue
+    for (slug, menu_type_slug, month), days in calendar.items():
+        key = {"slug": slug, "menu_type_slug": menu_type_slug, "month": month}
+        menu_calendar.replace_one(key, {**key, "days": sorted(days)}, upsert=True)
 
-        monthly_view.append(MonthlyViewDay(day=result_day["menu"]["date"], has_menu_items=True))
+    print(f"Rebuilt {len(calendar)} calendar months", flush=True)
+
+def monthly_view_range(year: int, month: int) -> tuple[str, str, list[str]]:
+    start = (datetime(year, month, 1) - timedelta(days=7)).strftime("%Y-%m-%d")
+    end = (datetime(year, month, 1) + timedelta(days=31 + 7)).strftime("%Y-%m-%d")
+
+    months = sorted(set([start[:7], f"{year:04}-{month:02}", end[:7]]))
+
+    return start, end, months
+
+def calendar_to_monthly_view(calendar_months: list[dict[str, Any]], start: str, end: str) -> list[MonthlyViewDay]:
+    monthly_view = []
+
+    for calendar_month in calendar_months:
+        for day in calendar_month["days"]:
+            if start <= day <= end:
+                monthly_view.append(MonthlyViewDay(day=day, has_menu_items=True))
 
     return sorted(monthly_view, key=lambda x: x.day)
+
+async def get_monthly_view_async(year: int, month: int, slug: str, menu_type_slug: str) -> list[MonthlyViewDay]:
+    key = ("monthly-view", year, month, slug, menu_type_slug)
+    found, monthly_view = menu_cache.get(key)
+    if found:
+        return monthly_view
+
+    monthly_view_generation = generation.generation
+    start, end, months = monthly_view_range(year, month)
+
+    result = await async_menu_calendar.find({"slug": slug, "menu_type_slug": menu_type_slug, "month": {"$in": months}}).to_list(None)
+
+    monthly_view = calendar_to_monthly_view(result, start, end)
+    menu_cache.put(key, monthly_view, monthly_view_generation)
+
+    return monthly_view
+
+if __name__ != "__main__":
+    config_writer.on_acquired.append(take_over_config_in_background)
+    config_writer.start()
+
+if __name__ == "__main__":
+    import sys
+
+    # Every command writes config or shared collections, so it runs as the
+    # config writer and never alongside one
+    if len(sys.argv) > 1:
+        config_writer.start()
+        if not config_writer.held:
+            print("Another worker holds the config-writer lease; stop the app or wait for the lease to expire", flush=True)
+            sys.exit(1)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "reconcile-config":
+        reconcile_config(full="--full" in sys.argv)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-menus":
+        rebuild_menus()
+        generation.bump_generation()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-calendar":
+        rebuild_calendar()
+        generation.bump_generation()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-catalog":
+        rebuild_catalog()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-latest-versions":
+        rebuild_latest_versions()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "drop-latest-item-version-cache":
+        db.drop_collection("latest-item-version-cache")
+        print("Dropped latest-item-version-cache", flush=True)
+
+    config_writer.release()
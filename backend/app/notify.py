@@ -1,6 +1,238 @@
 # app/notify.py
 # Author: Larry Qiu
 # Date: 1/22/2023
-# Purpose: Periodically notify users and other daily logic. 
+# Purpose: Periodically notify users and other daily logic.
 #          Called seperately from the main app.
+#          python3.9 notify.py [date]
 
+import os
+import sys
+import time
+import requests
+import pytz
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from typing import Any, Optional
+from ruamel.yaml import YAML
+
+from schema import *
+from database import db
+
+# Pointed at a local stub server when testing
+EXPO_PUSH_URL = os.environ.get("EXPO_PUSH_URL", "https://exp.host/--/api/v2/push/send")
+EXPO_RECEIPTS_URL = os.environ.get("EXPO_RECEIPTS_URL", "https://exp.host/--/api/v2/push/getReceipts")
+EXPO_ACCESS_TOKEN = os.environ.get("EXPO_ACCESS_TOKEN")
+
+# Expo accepts at most 100 messages per push request and 1000 ids per receipt request
+PUSH_CHUNK_SIZE = 100
+RECEIPT_CHUNK_SIZE = 1000
+
+NOTIFY_DAYS = int(os.environ.get("NOTIFY_DAYS", "1"))
+NOTIFY_CONCURRENCY = int(os.environ.get("NOTIFY_CONCURRENCY", "6"))
+NOTIFY_MAX_RETRIES = int(os.environ.get("NOTIFY_MAX_RETRIES", "3"))
+NOTIFY_RETRY_BASE_SECONDS = float(os.environ.get("NOTIFY_RETRY_BASE_SECONDS", "1"))
+# Expo suggests waiting before receipts are read; 0 skips the receipt pass
+NOTIFY_RECEIPT_DELAY_SECONDS = float(os.environ.get("NOTIFY_RECEIPT_DELAY_SECONDS", "900"))
+
+LOCATIONS_FILE = "config/locations.yml"
+
+users = db["users"]
+menus = db["menus"]
+menu_items = db["menu-items"]
+
+session = requests.Session()
+session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip, deflate"})
+if EXPO_ACCESS_TOKEN is not None:
+    session.headers.update({"Authorization": f"Bearer {EXPO_ACCESS_TOKEN}"})
+
+def chunks(items: list[Any], size: int) -> list[list[Any]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# Building the notifications
+
+def load_menu_names() -> dict[tuple[str, str], str]:
+    # (location slug, menu type slug) -> "Dewick-MacPhie Dining Center lunch"
+    # for every displayed menu
+    with open(LOCATIONS_FILE, 'r') as file:
+        locations = YAML().load(file) or {}
+
+    names = {}
+    for location in locations.values():
+        location = Location(**location)
+        if not location.displayed:
+            continue
+
+        for menu_type in location.menu_types:
+            if menu_type.displayed:
+                names[(location.slug, menu_type.slug)] = f"{location.name} {menu_type.name.lower()}"
+
+    return names
+
+def find_version_groups(hashes: set[MenuItemHash]) -> dict[MenuItemHash, str]:
+    # Grouped hashes share their food version name in the catalog; anything
+    # else is its own group
+    groups = {hash: hash for hash in hashes}
+    for item in menu_items.find({"hash": {"$in": list(hashes)}, "food_version": {"$ne": None}}, {"hash": 1, "food_version": 1}):
+        groups[item["hash"]] = item["food_version"]
+
+    return groups
+
+def build_notifications(dates: list[Date]) -> list[dict[str, Any]]:
+    # One read of the upcoming menus and one of the subscribed users. Users are
+    # indexed by the version groups they follow, so the work is linear in
+    # subscriptions and menu items rather than users times menus.
+    menu_names = load_menu_names()
+
+    upcoming = list(menus.find({"date": {"$in": dates}, "menu": {"$ne": None}}))
+    subscribers = list(users.find(
+        {"notification_token": {"$ne": None}, "notified_items.0": {"$exists": True}},
+        {"notification_token": 1, "notified_items": 1}
+    ))
+
+    served_hashes = set()
+    for menu in upcoming:
+        for section in menu["menu"]["sections"]:
+            for item in section["menu_items"]:
+                served_hashes.add(item["menu_item"]["hash"])
+
+    subscribed_hashes = set(hash for user in subscribers for hash in user["notified_items"])
+    groups = find_version_groups(served_hashes | subscribed_hashes)
+
+    tokens_by_group = defaultdict(set)
+    for user in subscribers:
+        for hash in user["notified_items"]:
+            tokens_by_group[groups[hash]].add(user["notification_token"])
+
+    # token -> {(date, item name, menu name)}
+    matches = defaultdict(set)
+    for menu in sorted(upcoming, key=lambda x: x["date"]):
+        menu_name = menu_names.get((menu["slug"], menu["menu_type_slug"]))
+        if menu_name is None:
+            continue
+
+        for section in menu["menu"]["sections"]:
+            for item in section["menu_items"]:
+                for token in tokens_by_group.get(groups[item["menu_item"]["hash"]], ()):
+                    matches[token].add((menu["date"], item["menu_item"]["name"], menu_name))
+
+    messages = []
+    for token, served in matches.items():
+        served = sorted(served)
+        lines = [f"{name} at {menu_name}" for _, name, menu_name in served]
+        messages.append({
+            "to": token,
+            "title": "Your favorites are on the menu" if len(dates) > 1 else "Your favorites are on the menu today",
+            "body": "\n".join(lines[:5]) + (f"\nand {len(lines) - 5} more" if len(lines) > 5 else ""),
+            "sound": "default",
+            "data": {"dates": sorted(set(date for date, _, _ in served))},
+        })
+
+    print(f"Built {len(messages)} notifications from {len(upcoming)} menus and {len(subscribed_hashes)} followed items of {len(subscribers)} users", flush=True)
+
+    return messages
+
+# Sending
+
+def post_with_retries(url: str, payload: dict[str, Any]) -> Optional[dict[str, Any]]:
+    # Retries connection errors, rate limiting and server errors with
+    # exponential backoff; other errors fail the request immediately
+    for attempt in range(NOTIFY_MAX_RETRIES + 1):
+        try:
+            response = session.post(url, json=payload, timeout=30)
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                return response.json()
+
+            print(f"Push service returned {response.status_code} (attempt {attempt + 1})", flush=True)
+        except requests.HTTPError as e:
+            print(f"Push request rejected: {e}", flush=True)
+            return None
+        except (requests.RequestException, ValueError) as e:
+            print(f"Push request failed: {e} (attempt {attempt + 1})", flush=True)
+
+        if attempt < NOTIFY_MAX_RETRIES:
+            time.sleep(NOTIFY_RETRY_BASE_SECONDS * 2 ** attempt)
+
+    return None
+
+def send_chunk(messages: list[dict[str, Any]]) -> list[Optional[dict[str, Any]]]:
+    # One ticket per message, or None for every message if the chunk failed
+    result = post_with_retries(EXPO_PUSH_URL, messages)
+    if result is None or len(result.get("data", [])) != len(messages):
+        return [None] * len(messages)
+
+    return result["data"]
+
+def is_unregistered(status: dict[str, Any]) -> bool:
+    return (status.get("details") or {}).get("error") == "DeviceNotRegistered"
+
+def send_messages(messages: list[dict[str, Any]]) -> tuple[dict[str, str], set[str], dict[str, int]]:
+    # Returns ticket id -> token for accepted messages, the tokens Expo no
+    # longer knows and counts for the summary
+    tickets = {}
+    unregistered = set()
+    summary = {"sent": 0, "failed": 0, "errors": 0}
+
+    with ThreadPoolExecutor(max_workers=NOTIFY_CONCURRENCY) as executor:
+        batches = chunks(messages, PUSH_CHUNK_SIZE)
+        for batch, statuses in zip(batches, executor.map(send_chunk, batches)):
+            for message, status in zip(batch, statuses):
+                if status is None:
+                    summary["failed"] += 1
+                elif status.get("status") == "ok":
+                    tickets[status["id"]] = message["to"]
+                    summary["sent"] += 1
+                else:
+                    if is_unregistered(status):
+                        unregistered.add(message["to"])
+                    summary["errors"] += 1
+
+    return tickets, unregistered, summary
+
+def check_receipts(tickets: dict[str, str]) -> tuple[set[str], dict[str, int]]:
+    unregistered = set()
+    summary = {"delivered": 0, "undelivered": 0, "unknown": 0}
+
+    with ThreadPoolExecutor(max_workers=NOTIFY_CONCURRENCY) as executor:
+        batches = chunks(list(tickets.keys()), RECEIPT_CHUNK_SIZE)
+        for batch, result in zip(batches, executor.map(lambda ids: post_with_retries(EXPO_RECEIPTS_URL, {"ids": ids}), batches)):
+            receipts = result.get("data", {}) if result is not None else {}
+            for id in batch:
+                receipt = receipts.get(id)
+                if receipt is None:
+                    summary["unknown"] += 1
+                elif receipt.get("status") == "ok":
+                    summary["delivered"] += 1
+                else:
+                    if is_unregistered(receipt):
+                        unregistered.add(tickets[id])
+                    summary["undelivered"] += 1
+
+    return unregistered, summary
+
+def forget_tokens(tokens: set[str]):
+    if len(tokens) > 0:
+        users.update_many({"notification_token": {"$in": list(tokens)}}, {"$set": {"notification_token": None}})
+
+def notify(dates: list[Date]):
+    start = time.perf_counter()
+    messages = build_notifications(dates)
+
+    tickets, unregistered, summary = send_messages(messages)
+    print(f"Pushed {summary['sent']} notifications, {summary['errors']} rejected, {summary['failed']} failed in {time.perf_counter() - start:.1f}s", flush=True)
+    forget_tokens(unregistered)
+
+    if NOTIFY_RECEIPT_DELAY_SECONDS > 0 and len(tickets) > 0:
+        time.sleep(NOTIFY_RECEIPT_DELAY_SECONDS)
+        unregistered, summary = check_receipts(tickets)
+        print(f"Receipts: {summary['delivered']} delivered, {summary['undelivered']} undelivered, {summary['unknown']} not yet available", flush=True)
+        forget_tokens(unregistered)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        first_date = datetime.strptime(sys.argv[1], "%Y-%m-%d")
+    else:
+        first_date = datetime.now(pytz.timezone('US/Eastern'))
+
+    notify([(first_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(NOTIFY_DAYS)])
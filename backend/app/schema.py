@@ -133,3 +133,45 @@ def scrape_to_menu_item(item: dict[str, Any]) -> Optional[MenuItem]:
     )
 
     return menu_item
+
+def scrape_to_base_menu(scraping_result: dict[str, Any]) -> Optional[Menu]:
+    if "menu_info" not in scraping_result or "menu_items" not in scraping_result:
+        return None
+    date = scraping_result["date"]
+    menu_info = scraping_result["menu_info"]
+    menu_items = scraping_result["menu_items"]
+
+    raw_sections = [{"id": key, "items": [], **value} for key, value in menu_info.items()]
+    raw_sections.sort(key=lambda x: x["position"])
+
+    for item in menu_items:
+        for section in raw_sections:
+            if str(item["menu_id"]) == str(section["id"]):
+                section["items"].append(item)
+
+    for section in raw_sections:
+        section["items"].sort(key=lambda x: x["position"])
+
+    menu = Menu(date = date, sections = [])
+
+    for raw_section in raw_sections:
+        if "section_options" not in raw_section or raw_section["section_options"] is None:
+            raw_section["section_options"] = {"display_name": "None"}
+
+        section = Menu.Section(name=str(raw_section["section_options"]["display_name"]), menu_items=[])
+        for item in raw_section["items"]:
+            menu_item = scrape_to_menu_item(item)
+            if menu_item is None:
+                continue
+
+            section.menu_items.append(DatedMenuItem(menu_item=menu_item, date=date, latest_version=None))
+
+        if len(section.menu_items) == 0:
+            continue
+
+        menu.sections.append(section)
+
+    if len(menu.sections) == 0:
+        return None
+
+    return menu
@@ -7,83 +7,257 @@ import base64
 from openai import AsyncOpenAI
 import os
 import requests
-from PIL import Image
-from io import BytesIO
-import pandas as pd
 import numpy as np
 from database import db
 from schema import *
 import menu_management
+import images
 import ijson
-from typing import Iterator
+from typing import Iterator, BinaryIO
 import json
 from fuzzywuzzy import fuzz
 import asyncio
+from datetime import datetime
+from collections import OrderedDict
+from pymongo import UpdateOne
 client = AsyncOpenAI()
 
+MAX_CONCURRENT_MATCHES = int(os.environ.get("VISION_MAX_CONCURRENT_MATCHES", "4"))
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
 menu_item_embeddings = db["menu-item-embeddings"]
+query_embeddings = db["query-embeddings"]
+menu_item_embeddings.create_index("name")
+query_embeddings.create_index([("text", 1), ("model", 1)], unique=True)
+EMBEDDING_BATCH_SIZE = 512
+EMBEDDINGS_READY_TIMEOUT_SECONDS = float(os.environ.get("VISION_READY_TIMEOUT_SECONDS", "60"))
+
+# Vision results are replayed for near-duplicate photos. The 64-bit image
+# hash is split into 8 bands and candidates must share at least one, which
+# finds every match within a Hamming distance of 7.
+vision_results = db["vision-results"]
+VISION_CACHE_TTL_SECONDS = int(os.environ.get("VISION_CACHE_TTL_SECONDS", 60 * 60 * 24))
+VISION_CACHE_MAX_DISTANCE = min(int(os.environ.get("VISION_CACHE_MAX_DISTANCE", "4")), 7)
+vision_results.create_index("cache_date", expireAfterSeconds=VISION_CACHE_TTL_SECONDS)
+vision_results.create_index("bands")
+
 embeddings = None
+embeddings_ready = asyncio.Event()
+embeddings_lock = asyncio.Lock()
 # Menu item embeddings
 
+class EmbeddingIndex:
+    # Nearest-neighbour search over unit-normalized float32 embeddings. On
+    # unit vectors, ranking by dot product matches ranking by euclidean distance.
+    def __init__(self, names: list[str], vectors: list[list[float]]):
+        self.names = names
+        self.positions = {name: i for i, name in enumerate(names)}
+        self.matrix = EmbeddingIndex.normalize(vectors)
+
+    @staticmethod
+    def normalize(vectors) -> np.ndarray:
+        matrix = np.array(vectors, dtype=np.float32, order="C", ndmin=2)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        matrix /= norms
+        return matrix
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def search(self, vector: list[float], k: int = 3, candidates: Optional[list[str]] = None) -> list[str]:
+        return self.search_batch([vector], k, candidates)[0]
+
+    def search_batch(self, vectors: list[list[float]], k: int = 3, candidates: Optional[list[str]] = None) -> list[list[str]]:
+        # With candidates, only those rows of the matrix are searched. Unknown
+        # names are ignored and an empty selection searches everything.
+        rows = np.arange(len(self.names))
+        if candidates is not None:
+            selected = [self.positions[name] for name in set(candidates) if name in self.positions]
+            if len(selected) > 0:
+                rows = np.array(sorted(selected))
+
+        k = min(k, len(rows))
+        if k == 0:
+            return [[] for _ in vectors]
+
+        matrix = self.matrix if len(rows) == len(self.names) else self.matrix[rows]
+        scores = EmbeddingIndex.normalize(vectors) @ matrix.T
+
+        # argpartition finds the top k in linear time, then only those k are sorted
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+
+        return [[self.names[rows[i]] for i in row] for row in top]
+
+
+async def update_embeddings():
+    # Brings the index in line with food_versions. Stored embeddings for new
+    # names are loaded with one query and the rest are requested in batches.
+    # Only the config writer generates embeddings; other workers pick them up
+    # from the collection on a later call.
+    async with embeddings_lock:
+        await update_embeddings_locked()
+
+    # Other workers can be behind the writer; they only report ready once
+    # the index covers every food version
+    if missing_embeddings() == 0:
+        embeddings_ready.set()
+
+def missing_embeddings() -> int:
+    known_names = set(embeddings.names) if embeddings is not None else set()
+    return sum(1 for name in menu_management.food_versions.keys() if name not in known_names)
+
+async def update_embeddings_locked():
+    global embeddings
+    current = embeddings if embeddings is not None else EmbeddingIndex([], [])
+
+    # Drop names that were merged or removed from food_versions
+    kept_rows = [i for i, name in enumerate(current.names) if name in menu_management.food_versions]
+    if len(kept_rows) < len(current):
+        current = EmbeddingIndex([current.names[i] for i in kept_rows], current.matrix[kept_rows])
+
+    known_names = set(current.names)
+    missing_names = [name for name in menu_management.food_versions.keys() if name not in known_names]
+
+    if len(missing_names) > 0:
+        found = {}
+        stored = await asyncio.to_thread(lambda: list(menu_item_embeddings.find({"name": {"$in": missing_names}})))
+        for embedding_db in stored:
+            found[embedding_db["name"]] = embedding_db["embedding"]
+
+        to_generate = [name for name in missing_names if name not in found] if menu_management.config_writer.held else []
+        for start in range(0, len(to_generate), EMBEDDING_BATCH_SIZE):
+            batch = to_generate[start:start + EMBEDDING_BATCH_SIZE]
+            response = await client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=batch
+            )
+            documents = [{"name": batch[data.index], "embedding": data.embedding} for data in response.data]
+            await asyncio.to_thread(menu_item_embeddings.insert_many, documents)
+
+            for document in documents:
+                found[document["name"]] = document["embedding"]
+
+            print(f"Generated {len(documents)} embeddings", flush=True)
+
+        new_names = [name for name in missing_names if name in found]
+        if len(new_names) > 0:
+            vectors = [found[name] for name in new_names]
+            if len(current) > 0:
+                vectors = np.concatenate([current.matrix, EmbeddingIndex.normalize(vectors)])
+
+            current = EmbeddingIndex(current.names + new_names, vectors)
+
+    embeddings = current
 
 async def generate_embeddings():
-    global embeddings
-    embeddings = {}
-    for name, hashes in menu_management.food_versions.items():
-        embedding_db = menu_item_embeddings.find_one({"name": name})
-        if embedding_db is None:
+    try:
+        await update_embeddings()
+        print("Embeddings loaded", flush=True)
+    except Exception as e:
+        print(f"Failed to load embeddings: {e}", flush=True)
+        raise
+
+async def wait_for_embeddings() -> bool:
+    try:
+        await asyncio.wait_for(embeddings_ready.wait(), timeout=EMBEDDINGS_READY_TIMEOUT_SECONDS)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+class EmbeddingCache:
+    # Embeddings of query strings, kept in an in-process LRU in front of a
+    # Mongo collection. Keys are the normalized text and the model name.
+    def __init__(self, collection, max_size: int = 2048):
+        self.collection = collection
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.stats = {"memory_hits": 0, "database_hits": 0, "misses": 0}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.casefold().split())
+
+    def remember(self, key: tuple[str, str], embedding: list[float]):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get_many(self, texts: list[str], model: str = EMBEDDING_MODEL) -> list[list[float]]:
+        keys = [(EmbeddingCache.normalize(text), model) for text in texts]
+        found = {}
+
+        for key in keys:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                found[key] = self.entries[key]
+                self.stats["memory_hits"] += 1
+
+        missing = list(set(key[0] for key in keys if key not in found))
+        if len(missing) > 0:
+            stored = await asyncio.to_thread(lambda: list(self.collection.find({"text": {"$in": missing}, "model": model})))
+            for document in stored:
+                key = (document["text"], model)
+                found[key] = document["embedding"]
+                self.remember(key, document["embedding"])
+                self.stats["database_hits"] += 1
+
+        missing = [text for text in missing if (text, model) not in found]
+        if len(missing) > 0:
             response = await client.embeddings.create(
-                model="text-embedding-3-small",
-                input=name
+                model=model,
+                input=missing
             )
-            embedding = response.data[0].embedding
-            menu_item_embeddings.insert_one({"name": name, "embedding": embedding})
+            operations = []
+            for data in response.data:
+                key = (missing[data.index], model)
+                found[key] = data.embedding
+                self.remember(key, data.embedding)
+                operations.append(UpdateOne({"text": key[0], "model": model}, {"$set": {"embedding": data.embedding}}, upsert=True))
+                self.stats["misses"] += 1
 
-            print(f"Generated embedding for {name}", flush=True)
-        else:
-            embedding = embedding_db["embedding"]
-        embeddings[name] = embedding
-    
-    print("Embeddings loaded", flush=True)
+            await asyncio.to_thread(self.collection.bulk_write, operations, ordered=False)
 
-    embeddings = pd.DataFrame(embeddings).T
+        return [found[key] for key in keys]
+
+query_embedding_cache = EmbeddingCache(query_embeddings)
 
 # loop = asyncio.get_event_loop()
 # loop.run_until_complete(generate_embeddings())
-asyncio.create_task(generate_embeddings())
+embeddings_task = asyncio.create_task(generate_embeddings())
 
 
-async def closest_menu_items(name: str) -> list[str]:
-    response = await client.embeddings.create(
-        model="text-embedding-3-small",
-        input=name
-    )
-    embedding = response.data[0].embedding
-    distances = embeddings.apply(lambda x: np.linalg.norm(x - embedding), axis=1)
-    return list(distances.sort_values().index[:3])
+async def closest_menu_items(name: str, candidates: Optional[list[str]] = None) -> list[str]:
+    return (await closest_menu_items_batch([name], candidates))[0]
 
+async def closest_menu_items_batch(names: list[str], candidates: Optional[list[str]] = None) -> list[list[str]]:
+    await embeddings_ready.wait()
+    vectors = await query_embedding_cache.get_many(names)
+    return embeddings.search_batch(vectors, k=3, candidates=candidates)
+
+def served_food_versions(date: Date, slug: str, menu_type_slug: str) -> Optional[dict[str, MenuItemHash]]:
+    # Food version -> the hash of it being served. Only the hashes are needed,
+    # so latest versions are not filled in
+    menu = menu_management.get_base_menu(date, slug, menu_type_slug)
+    if menu is None:
+        return None
+
+    food_versions = {}
+    for section in menu.sections:
+        for item in section.menu_items:
+            food_version = menu_management.find_food_version(item.menu_item.hash)
+            if food_version is not None:
+                food_versions[food_version] = item.menu_item.hash
+
+    return food_versions
 
-def load_image(image_path: str, max_width:int=1024, max_height:int=1024) -> str:
-    image = Image.open(image_path)
-    image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-    
-    buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    url = f"data:image/jpeg;base64,{b64}"
-    return url
-
-def load_image_bytes(image_bytes: bytes, max_width:int=1024, max_height:int=1024) -> str:
-    image = Image.open(BytesIO(image_bytes))
-    image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-    
-    buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    url = f"data:image/jpeg;base64,{b64}"
-    return url
 
-async def item_str_to_item(name: str, amount: str) -> tuple[MenuItem, int]:
+async def item_str_to_item(name: str, amount: str, candidates: Optional[dict[str, MenuItemHash]] = None) -> tuple[MenuItem, int]:
     SYSTEM_PROMPT = """
     You are responsible for matching a dish name to the closest item in a menu and estimating the number of servings. \
     You will be given a list of menu items and serving sizes. If none of the potential items are in any way related, repond with null. \
@@ -97,8 +271,18 @@ async def item_str_to_item(name: str, amount: str) -> tuple[MenuItem, int]:
     
     menu_items = []
 
-    for potential_name in await closest_menu_items(name):
-        menu_item = menu_management.get_menu_item(menu_management.food_versions[potential_name][0])
+    for potential_name in await closest_menu_items(name, list(candidates) if candidates is not None else None):
+        # Match the version on the menu, not the oldest one in its group
+        hash = candidates.get(potential_name) if candidates is not None else None
+        if hash is None:
+            hashes = menu_management.food_versions.get(potential_name)
+            if not hashes:
+                continue
+            hash = hashes[0]
+
+        menu_item = await asyncio.to_thread(menu_management.get_menu_item, hash)
+        if menu_item is None:
+            continue
         menu_items.append(menu_item)
 
         USER_PROMPT += f"- {menu_item.name}, serving size: {menu_item.serving_size.amount}{menu_item.serving_size.unit}\n"
@@ -146,7 +330,7 @@ async def item_str_to_item(name: str, amount: str) -> tuple[MenuItem, int]:
 
 
 
-async def find_items(image_url: str) -> Iterator[str]:
+async def find_items(image_url: str, candidates: Optional[dict[str, MenuItemHash]] = None) -> Iterator[str]:
     SYSTEM_PROMPT = """
     You are responsible for annotating meal photos. First, creatively describe the meal. \
     Then, identify EVERY menu item in the image \
@@ -179,44 +363,120 @@ async def find_items(image_url: str) -> Iterator[str]:
         stream=True
     )
 
-    summary_events = ijson.sendable_list()
-    menu_items_events = ijson.sendable_list()
-    summary_coro = ijson.items_coro(summary_events, 'summary')
-    menu_items_coro = ijson.items_coro(menu_items_events, 'menu_items.item')
-    async for chunk in response:
-        res = chunk.choices[0].delta.content
-        if res == None:
-            continue
-
-        summary_coro.send(res.encode("utf-8"))
-        menu_items_coro.send(res.encode("utf-8"))
-
-        for event in summary_events:
-            yield "data: " + json.dumps({"summary": event}) + "\n\n"
-
-        for event in menu_items_events:
-            menu_item, servings = await item_str_to_item(event["name"], event["amount"])
-            if menu_item is None:
-                continue
-            yield "data: " + json.dumps({"menu_item": menu_item.model_dump(mode='json'), "servings": servings}) + "\n\n"
-       
-
-        del summary_events[:]
-        del menu_items_events[:]
+    # Matching runs as concurrent tasks while the stream is still being read.
+    # Everything sent to the client goes through this queue, with None marking
+    # the end of the stream.
+    events = asyncio.Queue()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_MATCHES)
+
+    async def match_item(event):
+        async with semaphore:
+            menu_item, servings = await item_str_to_item(event["name"], event["amount"], candidates)
+        if menu_item is None:
+            return
+        await events.put("data: " + json.dumps({"menu_item": menu_item.model_dump(mode='json'), "servings": servings}) + "\n\n")
+
+    async def read_response():
+        summary_events = ijson.sendable_list()
+        menu_items_events = ijson.sendable_list()
+        summary_coro = ijson.items_coro(summary_events, 'summary')
+        menu_items_coro = ijson.items_coro(menu_items_events, 'menu_items.item')
+        tasks = []
+        try:
+            async for chunk in response:
+                res = chunk.choices[0].delta.content
+                if res == None:
+                    continue
+
+                summary_coro.send(res.encode("utf-8"))
+                menu_items_coro.send(res.encode("utf-8"))
+
+                for event in summary_events:
+                    await events.put("data: " + json.dumps({"summary": event}) + "\n\n")
+
+                for event in menu_items_events:
+                    tasks.append(asyncio.create_task(match_item(event)))
+
+                del summary_events[:]
+                del menu_items_events[:]
+
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            summary_coro.close()
+            menu_items_coro.close()
+            await events.put(None)
+
+    reader = asyncio.create_task(read_response())
+    try:
+        while (event := await events.get()) is not None:
+            yield event
+    finally:
+        if not reader.done():
+            reader.cancel()
+
+    await reader
     yield "data: " + json.dumps({"status": "stop"}) + "\n\n"
 
-    summary_coro.close()
-    menu_items_coro.close()
-
-async def analyze_image(image):
+def image_hash_bands(image_hash: int) -> list[str]:
+    return [f"{band}:{(image_hash >> (band * 8)) & 0xff:02x}" for band in range(8)]
+
+def find_cached_vision_result(image_hash: int, context: Optional[str]) -> Optional[list[str]]:
+    best_distance = VISION_CACHE_MAX_DISTANCE + 1
+    best_events = None
+    for result in vision_results.find({"bands": {"$in": image_hash_bands(image_hash)}, "context": context}):
+        distance = bin(int(result["hash"], 16) ^ image_hash).count("1")
+        if distance < best_distance:
+            best_distance = distance
+            best_events = result["events"]
+
+    return best_events
+
+def cache_vision_result(image_hash: int, context: Optional[str], events: list[str]):
+    vision_results.insert_one({
+        "hash": f"{image_hash:016x}",
+        "bands": image_hash_bands(image_hash),
+        "context": context,
+        "events": events,
+        "cache_date": datetime.now(),
+    })
+
+async def analyze_image(image: BinaryIO, date: Optional[Date] = None, slug: Optional[str] = None, menu_type_slug: Optional[str] = None):
     yield "data: " + json.dumps({"status": "start"}) + "\n\n"
+
+    if not await wait_for_embeddings():
+        yield "data: " + json.dumps({"status": "error", "detail": "Menu item index is not ready"}) + "\n\n"
+        return
+
     print("Analyzing image", flush=True)
-    image_url = load_image_bytes(image)
+    image_url, image_hash = await images.preprocess_image(image)
     print("Image loaded", flush=True)
 
-    async for item in find_items(image_url):
+    # Searching only what is being served is faster and more accurate; without
+    # a location and meal type, or without a menu, fall back to everything
+    candidates = None
+    context = None
+    if date is not None and slug is not None and menu_type_slug is not None:
+        candidates = await asyncio.to_thread(served_food_versions, date, slug, menu_type_slug)
+        if candidates is not None:
+            context = f"{slug}/{menu_type_slug}/{date}"
+
+    cached_events = await asyncio.to_thread(find_cached_vision_result, image_hash, context)
+    if cached_events is not None:
+        print("Replaying cached analysis", flush=True)
+        for item in cached_events:
+            yield item
+        return
+
+    events = []
+    async for item in find_items(image_url, candidates):
+        events.append(item)
         yield item
 
+    await asyncio.to_thread(cache_vision_result, image_hash, context, events)
+
 
 # read all images in ./demo_images
 # image_dir = "./demo_images"
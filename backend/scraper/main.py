@@ -5,18 +5,42 @@
 #          the menu and store it in MongoDB
 
 import requests
-from pymongo import MongoClient
+from requests.adapters import HTTPAdapter
+from pymongo import MongoClient, InsertOne, UpdateOne
+from pymongo.errors import PyMongoError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+import threading
 import datetime
 import pytz
 import time
+import os
+import hashlib
+import json
 
-from schema import scrape_to_menu_item
+from schema import scrape_to_menu_item, scrape_to_base_menu
 
 PREFIX = "https://tufts.api.nutrislice.com"
 
-client = MongoClient('mongodb://mongo:27017/')
+# Fetch limits, shared by every worker thread
+MAX_REQUESTS_PER_SECOND = float(os.environ.get("SCRAPER_MAX_REQUESTS_PER_SECOND", "4"))
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get("SCRAPER_MAX_CONNECTIONS_PER_HOST", "4"))
+
+# Responses are cached on disk when SCRAPER_CACHE_DIR is set. With
+# SCRAPER_REPLAY=1 every fetch is served from that cache without network.
+CACHE_DIR = os.environ.get("SCRAPER_CACHE_DIR")
+REPLAY = os.environ.get("SCRAPER_REPLAY") == "1"
+
+client = MongoClient(os.environ.get("MONGO_URL", 'mongodb://mongo:27017/'))
 db = client['jumbo-appetit']
 raw_scrape_results = db['raw-scrape-results']
+menus = db['menus']
+menu_calendar = db['menu-calendar']
+menu_items = db['menu-items']
+# The app caches menus per data generation (see app/generation.py); bumping
+# it once the run is stored makes every worker drop what it built. The run's
+# scraping_date is recorded with it so the app only processes completed runs.
+data_generation = db['data-generation']
 
 def get_scraping_date_range():
     # Scraping Policy:
@@ -43,59 +67,368 @@ def get_scraping_date_range():
 
     return start_date, end_date
 
+def get_recorded_date_range():
+    with open(os.path.join(CACHE_DIR, "run.json"), "r") as file:
+        run = json.load(file)
+    return datetime.datetime.fromisoformat(run["start_date"]), datetime.datetime.fromisoformat(run["end_date"])
+
+def record_date_range(start_date, end_date):
+    with open(os.path.join(CACHE_DIR, "run.json"), "w") as file:
+        json.dump({"start_date": start_date.isoformat(), "end_date": end_date.isoformat()}, file)
+
+def cache_path(url):
+    return os.path.join(CACHE_DIR, hashlib.md5(url.encode("utf-8"), usedforsecurity=False).hexdigest() + ".json")
+
+def load_cached_response(url):
+    if CACHE_DIR is None:
+        return None
+
+    try:
+        with open(cache_path(url), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def response_cache_entry(url, response):
+    return {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "body": response.text,
+    }
+
+def save_cached_response(entry):
+    # Only called once the response has been stored, otherwise the next run
+    # would get a 304 for content that never made it into the database
+    if CACHE_DIR is None or entry is None:
+        return
+
+    path = cache_path(entry["url"])
+
+    # Written to a temporary file first so a crash never leaves a torn entry
+    with open(path + ".tmp", "w") as file:
+        json.dump(entry, file)
+    os.replace(path + ".tmp", path)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+session = requests.Session()
+session.headers.update({"Accept": "application/json"})
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONNECTIONS_PER_HOST))
+
+rate_limiter = RateLimiter(MAX_REQUESTS_PER_SECOND)
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+
+def get_host_semaphore(url):
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return host_semaphores[host]
+
+def fetch_json(url):
+    # Returns the decoded body, whether the server reported it unchanged and
+    # the cache entry to save once the body is stored (None if nothing to save)
+    cached = load_cached_response(url)
+
+    if REPLAY:
+        if cached is None:
+            raise requests.RequestException(f"No recorded response for {url}")
+        # Replays run the full ingestion path, as a real fetch would
+        return json.loads(cached["body"]), False, None
+
+    headers = {}
+    if cached is not None:
+        if cached["etag"] is not None:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"] is not None:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    with get_host_semaphore(url):
+        rate_limiter.wait()
+        r = session.get(url, headers=headers, timeout=60)
+
+    if r.status_code == 304 and cached is not None:
+        return json.loads(cached["body"]), True, None
+
+    r.raise_for_status()
+    data = r.json()
+
+    entry = response_cache_entry(url, r) if CACHE_DIR is not None else None
+    return data, False, entry
 
 def get_schools():
     url = f"{PREFIX}/menu/api/schools/"
-    r = requests.get(url, headers={"Accept": "application/json"})
-    return r.json()
+    schools, _, entry = fetch_json(url)
+    save_cached_response(entry)
+    return schools
 
 def get_weekly_menu(slug, menu_type, monday):
     url = f"{PREFIX}/menu/api/weeks/school/{slug}/menu-type/{menu_type}/{monday.year}/{monday.month}/{monday.day}/"
-    r = requests.get(url, headers={"Accept": "application/json"})
-    return r.json()
+    return fetch_json(url)
+
+def timed_get_weekly_menu(slug, menu_type, monday):
+    start = time.perf_counter()
+    menu, not_modified, entry = get_weekly_menu(slug, menu_type, monday)
+    return menu, not_modified, entry, time.perf_counter() - start
+
+def materialize_menu(result, menu):
+    # Mirrors find_best_scrape_result in the app: a scrape taken on or before
+    # the day after the menu date always wins, so replace it. Older dates keep
+    # whatever was materialized closest to the day and only fill gaps.
+    key = {"slug": result["slug"], "menu_type_slug": result["menu_type_slug"], "date": result["date"]}
+    document = {
+        "scraping_date": result["scraping_date"],
+        "menu": menu.model_dump() if menu is not None else None
+    }
+
+    date = datetime.datetime.strptime(result["date"], "%Y-%m-%d")
+    if result["scraping_date"] <= date + datetime.timedelta(days=1):
+        menus.replace_one(key, {**key, **document}, upsert=True)
+    else:
+        menus.update_one(key, {"$setOnInsert": document}, upsert=True)
+
+def update_calendar(result, has_menu_items):
+    # The monthly view reflects the latest scrape of each day, which is always
+    # the one being written now
+    key = {"slug": result["slug"], "menu_type_slug": result["menu_type_slug"], "month": result["date"][:7]}
+    if has_menu_items:
+        menu_calendar.update_one(key, {"$addToSet": {"days": result["date"]}}, upsert=True)
+    else:
+        menu_calendar.update_one(key, {"$pull": {"days": result["date"]}})
+
+def day_fingerprint(day):
+    # Two scrapes of a day with the same fingerprint build the same menu:
+    # the sections (ids, order and names) and the items placed in them
+    h = hashlib.md5(usedforsecurity=False)
+    for section_id, section in sorted((day.get("menu_info") or {}).items(), key=lambda x: str(x[0])):
+        display_name = (section.get("section_options") or {}).get("display_name")
+        h.update(f"section:{section_id}:{section.get('position')}:{display_name};".encode("utf-8"))
+    for item in sorted(day["menu_items"], key=lambda x: (str(x["menu_id"]), x["position"])):
+        h.update(f"{item['menu_id']}:{item['position']}:{item['hash']};".encode("utf-8"))
+    return h.hexdigest()
+
+def find_latest_fingerprints(slug, menu_type_slug, dates):
+    result = raw_scrape_results.aggregate([
+        {
+            '$match': {
+                'slug': slug, 
+                'menu_type_slug': menu_type_slug, 
+                'date': {
+                    '$in': dates
+                }
+            }
+        }, {
+            '$sort': {
+                'scraping_date': -1
+            }
+        }, {
+            '$group': {
+                '_id': '$date', 
+                'id': {
+                    '$first': '$_id'
+                }, 
+                'fingerprint': {
+                    '$first': '$fingerprint'
+                }
+            }
+        }
+    ])
+
+    return {latest["_id"]: latest for latest in result}
+
+def touch_unmodified_week(result, menu):
+    # The server says the week is unchanged since the cached response, so the
+    # stored days only need their last_seen_date bumped. Days that were never
+    # stored are returned so they go through the normal path.
+    latest_fingerprints = find_latest_fingerprints(result["slug"], result["menu_type_slug"], [day["date"] for day in menu["days"]])
+
+    operations = []
+    unstored_days = []
+    for day in menu["days"]:
+        latest = latest_fingerprints.get(day["date"])
+        if latest is None:
+            unstored_days.append(day)
+            continue
+
+        operations.append(UpdateOne({"_id": latest["id"]}, {"$set": {"last_seen_date": result["scraping_date"]}}))
+
+    if len(operations) > 0:
+        raw_scrape_results.bulk_write(operations, ordered=False)
+
+    return unstored_days
+
+def update_catalog(days, parsed_items):
+    # New hashes are filed under their own food name, which is also how the
+    # app groups them until food_versions.yml says otherwise
+    operations = []
+    for day in days:
+        for item in day["menu_items"]:
+            menu_item = parsed_items[item["hash"]]
+            operations.append(UpdateOne(
+                {"hash": menu_item.hash},
+                {
+                    "$setOnInsert": {"menu_item": menu_item.model_dump(), "food_version": menu_item.name},
+                    "$min": {"first_seen_date": day["date"]},
+                    "$max": {"last_seen_date": day["date"]},
+                },
+                upsert=True
+            ))
+
+    if len(operations) > 0:
+        menu_items.bulk_write(operations, ordered=False)
+
+def store_weekly_menu(result, menu, not_modified=False):
+    days = menu["days"]
+    if not_modified:
+        days = touch_unmodified_week(result, menu)
+
+    parsed_items = {}
+    for day in days:
+        menu_items = day["menu_items"]
+        new_menu_items = []
+        for item in menu_items:
+            menu_item = scrape_to_menu_item(item)
+            if menu_item is None:
+                continue
+            item["hash"] = menu_item.hash
+            parsed_items[menu_item.hash] = menu_item
+            new_menu_items.append(item)
+        day["menu_items"] = new_menu_items
+
+    latest_fingerprints = find_latest_fingerprints(result["slug"], result["menu_type_slug"], [day["date"] for day in days])
+
+    operations = []
+    changed_days = []
+    for day in days:
+        fingerprint = day_fingerprint(day)
+        latest = latest_fingerprints.get(day["date"])
+
+        if latest is not None and latest.get("fingerprint") == fingerprint:
+            # Unchanged since the last scrape, only record that it was seen
+            operations.append(UpdateOne({"_id": latest["id"]}, {"$set": {"last_seen_date": result["scraping_date"]}}))
+            continue
+
+        document = {
+            **result,
+            "date": day["date"],
+            "scraping_result": day,
+            "fingerprint": fingerprint,
+            "last_seen_date": result["scraping_date"],
+        }
+        operations.append(InsertOne(document))
+        changed_days.append(document)
+
+    if len(operations) > 0:
+        raw_scrape_results.bulk_write(operations, ordered=False)
+
+    update_catalog([document["scraping_result"] for document in changed_days], parsed_items)
+
+    for document in changed_days:
+        day_menu = scrape_to_base_menu(document["scraping_result"])
+        materialize_menu(document, day_menu)
+        update_calendar(document, day_menu is not None)
+
+    return len(menu["days"]), len(changed_days)
+
+def print_summary(summary, elapsed):
+    print(f"Scraped in {elapsed:.1f}s", flush=True)
+    for slug, stats in sorted(summary.items()):
+        print(f"  {slug}: {stats['weeks']} weeks, {stats['days']} days ({stats['changed_days']} changed), {stats['errors']} errors, "
+              f"{stats['fetch_seconds']:.1f}s fetching, {stats['store_seconds']:.1f}s storing", flush=True)
 
 def scrape_all():
+    scrape_start = time.perf_counter()
     schools = get_schools()
-    start_date, end_date = get_scraping_date_range()
-    result = {
-        "scraping_start_date": start_date, 
-        "scraping_end_date": end_date, 
-        "scraping_date": datetime.datetime.now(),
-    }
 
+    if REPLAY:
+        start_date, end_date = get_recorded_date_range()
+    else:
+        start_date, end_date = get_scraping_date_range()
+        if CACHE_DIR is not None:
+            record_date_range(start_date, end_date)
+
+    scraping_date = datetime.datetime.now()
+
+    jobs = []
     for school in schools:
         slug = school['slug']
 
-        result["slug"] = slug
-
         for menu_type in school["active_menu_types"]:
             monday = start_date
             menu_type_slug = menu_type["slug"]
 
-            result["menu_type_slug"] = menu_type_slug
-
             while monday < end_date + datetime.timedelta(days=1):
-                print(f"Scraping {slug} {menu_type_slug} {monday.year}/{monday.month}/{monday.day}", flush=True)
-                menu = get_weekly_menu(slug, menu_type_slug, monday)
-
-                for day in menu["days"]:
-                    menu_items = day["menu_items"]
-                    new_menu_items = []
-                    for item in menu_items:
-                        menu_item = scrape_to_menu_item(item)
-                        if menu_item is None:
-                            continue
-                        item["hash"] = menu_item.hash
-                        new_menu_items.append(item)
-                    day["menu_items"] = new_menu_items
-
-                    result["date"] = day["date"]
-                    result["scraping_result"] = day
-
-                    raw_scrape_results.insert_one(result.copy())      
+                jobs.append((slug, menu_type_slug, monday))
                 monday += datetime.timedelta(days=7)
-                time.sleep(1)
+
+    summary = {}
+    for slug, _, _ in jobs:
+        summary[slug] = {"weeks": 0, "days": 0, "changed_days": 0, "errors": 0, "fetch_seconds": 0.0, "store_seconds": 0.0}
+
+    # Fetching runs on the pool; storing stays on this thread
+    with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS_PER_HOST) as executor:
+        futures = {executor.submit(timed_get_weekly_menu, *job): job for job in jobs}
+
+        for future in as_completed(futures):
+            slug, menu_type_slug, monday = futures[future]
+            stats = summary[slug]
+
+            try:
+                menu, not_modified, entry, fetch_seconds = future.result()
+            except (requests.RequestException, ValueError) as e:
+                print(f"Failed to scrape {slug} {menu_type_slug} {monday.year}/{monday.month}/{monday.day}: {e}", flush=True)
+                stats["errors"] += 1
+                continue
+
+            print(f"Scraped {slug} {menu_type_slug} {monday.year}/{monday.month}/{monday.day}", flush=True)
+
+            result = {
+                "scraping_start_date": start_date, 
+                "scraping_end_date": end_date, 
+                "scraping_date": scraping_date,
+                "slug": slug,
+                "menu_type_slug": menu_type_slug,
+            }
+
+            store_start = time.perf_counter()
+            try:
+                days, changed_days = store_weekly_menu(result, menu, not_modified)
+            except PyMongoError as e:
+                # The response is not cached, so the next run fetches it again
+                print(f"Failed to store {slug} {menu_type_slug} {monday.year}/{monday.month}/{monday.day}: {e}", flush=True)
+                stats["errors"] += 1
+                continue
+
+            save_cached_response(entry)
+            stats["days"] += days
+            stats["changed_days"] += changed_days
+            stats["store_seconds"] += time.perf_counter() - store_start
+            stats["fetch_seconds"] += fetch_seconds
+            stats["weeks"] += 1
+
+    data_generation.update_one({"_id": "menus"}, {"$inc": {"generation": 1}, "$max": {"completed_scraping_date": scraping_date}}, upsert=True)
+
+    print_summary(summary, time.perf_counter() - scrape_start)
 
 if __name__ == "__main__":
-    print("Scraping...", flush=True)
+    if CACHE_DIR is not None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+    print("Replaying recorded responses..." if REPLAY else "Scraping...", flush=True)
     scrape_all()
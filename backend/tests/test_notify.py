@@ -0,0 +1,158 @@
+# tests/test_notify.py
+# Author: Larry Qiu
+# Date: 10/18/2026
+# Purpose: Run the notification fan-out against a local Expo push stub.
+#          python3.9 -m pytest tests
+
+import os
+import sys
+import json
+import types
+import importlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+APP_DIR = os.path.join(os.path.dirname(__file__), "..", "app")
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), "..", "config")
+sys.path.insert(0, APP_DIR)
+
+DATE = "2024-05-01"
+
+class ExpoStub:
+    # Records every push request and answers with the queued status codes
+    # first. Tokens starting with "unregistered-ticket" are rejected in the
+    # push response, ones starting with "unregistered-receipt" in the receipts.
+    def __init__(self):
+        self.failures = []
+        self.push_sizes = []
+        self.push_attempts = 0
+        self.receipt_ids = []
+
+    def handle(self, path: str, body):
+        if path == "/push/send":
+            self.push_attempts += 1
+            if len(self.failures) > 0:
+                return self.failures.pop(0), {}
+
+            self.push_sizes.append(len(body))
+            tickets = []
+            for message in body:
+                if message["to"].startswith("unregistered-ticket"):
+                    tickets.append({"status": "error", "message": "not registered", "details": {"error": "DeviceNotRegistered"}})
+                else:
+                    tickets.append({"status": "ok", "id": f"ticket:{message['to']}"})
+            return 200, {"data": tickets}
+
+        if path == "/push/getReceipts":
+            self.receipt_ids.extend(body["ids"])
+            receipts = {}
+            for id in body["ids"]:
+                if id.startswith("ticket:unregistered-receipt"):
+                    receipts[id] = {"status": "error", "message": "not registered", "details": {"error": "DeviceNotRegistered"}}
+                else:
+                    receipts[id] = {"status": "ok"}
+            return 200, {"data": receipts}
+
+        return 404, {}
+
+@pytest.fixture
+def expo():
+    stub = ExpoStub()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            status, response = stub.handle(self.path, body)
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub.url = f"http://127.0.0.1:{server.server_port}/push"
+
+    yield stub
+
+    server.shutdown()
+
+@pytest.fixture
+def notify(expo, monkeypatch):
+    monkeypatch.setenv("EXPO_PUSH_URL", f"{expo.url}/send")
+    monkeypatch.setenv("EXPO_RECEIPTS_URL", f"{expo.url}/getReceipts")
+    monkeypatch.setenv("NOTIFY_RETRY_BASE_SECONDS", "0")
+    monkeypatch.setenv("NOTIFY_RECEIPT_DELAY_SECONDS", "0.01")
+
+    database = types.ModuleType("database")
+    database.db = mongomock.MongoClient()["jumbo-appetit"]
+    monkeypatch.setitem(sys.modules, "database", database)
+    monkeypatch.delitem(sys.modules, "notify", raising=False)
+
+    module = importlib.import_module("notify")
+    monkeypatch.setattr(module, "LOCATIONS_FILE", os.path.join(CONFIG_DIR, "locations.yml"))
+
+    def menu_item(hash, name):
+        return {"menu_item": {"hash": hash, "name": name}, "date": DATE, "latest_version": None}
+
+    # "pizza-2" is served; followers of either pizza hash are notified
+    module.menus.insert_one({
+        "slug": "carmichael-dining-hall",
+        "menu_type_slug": "lunch",
+        "date": DATE,
+        "menu": {"date": DATE, "sections": [{"name": "Grill", "menu_items": [menu_item("pizza-2", "Pizza"), menu_item("soup", "Soup")]}]},
+    })
+    module.menu_items.insert_many([
+        {"hash": "pizza-1", "food_version": "Pizza"},
+        {"hash": "pizza-2", "food_version": "Pizza"},
+    ])
+
+    return module
+
+def add_users(notify, tokens, notified_items):
+    notify.users.insert_many([{"notification_token": token, "notified_items": notified_items} for token in tokens])
+
+def test_pushes_in_chunks_of_100(notify, expo):
+    add_users(notify, [f"token-{i}" for i in range(250)], ["pizza-1"])
+
+    notify.notify([DATE])
+
+    assert sorted(expo.push_sizes) == [50, 100, 100]
+    assert len(expo.receipt_ids) == 250
+
+def test_retries_rate_limits_and_server_errors(notify, expo):
+    add_users(notify, [f"token-{i}" for i in range(10)], ["soup"])
+    expo.failures = [429, 503]
+
+    tickets, unregistered, summary = notify.send_messages(notify.build_notifications([DATE]))
+
+    assert expo.push_attempts == 3
+    assert summary == {"sent": 10, "failed": 0, "errors": 0}
+    assert len(tickets) == 10
+
+def test_gives_up_after_max_retries(notify, expo):
+    add_users(notify, ["token"], ["soup"])
+    expo.failures = [500] * (notify.NOTIFY_MAX_RETRIES + 1)
+
+    tickets, unregistered, summary = notify.send_messages(notify.build_notifications([DATE]))
+
+    assert expo.push_attempts == notify.NOTIFY_MAX_RETRIES + 1
+    assert summary["failed"] == 1
+
+def test_forgets_unregistered_tokens(notify, expo):
+    add_users(notify, ["token", "unregistered-ticket", "unregistered-receipt"], ["pizza-2"])
+    add_users(notify, ["unsubscribed"], [])
+
+    notify.notify([DATE])
+
+    tokens = set(user["notification_token"] for user in notify.users.find())
+    assert tokens == {"token", None, "unsubscribed"}
+    assert notify.users.count_documents({"notification_token": None}) == 2